@@ -1,33 +1,99 @@
 from math import pi, sin, cos
-from os import unlink, close
+from os import unlink, close, getpid
+from threading import Lock
 from tempfile import mkstemp
-from os.path import exists
+from os.path import exists, getsize
 
-from osgeo import gdal
-from PIL import Image
 import numpy
 
-__all__ = 'data', 'tiles'
+__all__ = 'data', 'tiles', 'arena'
+
+#
+# Stored in place of a slope and aspect GeoTIFF for tiles
+# with no elevation data at all, e.g. over open ocean.
+#
+nodata_tile = 'Hillup: no elevation data\n'
+
+#
+# GeoTIFF creation options for each codec of slope and aspect tiles.
+# Readers don't need to know which was used, GDAL works it out. The
+# horizontal differencing predictor helps the lossless codecs with smooth
+# terrain, and uncompressed "raw" tiles can be read with a plain seek.
+# ZSTD needs GDAL 2.3 or later.
+#
+codecs = {
+    'jpeg': ['COMPRESS=JPEG', 'JPEG_QUALITY=95', 'INTERLEAVE=BAND'],
+    'deflate': ['COMPRESS=DEFLATE', 'PREDICTOR=2', 'INTERLEAVE=BAND'],
+    'zstd': ['COMPRESS=ZSTD', 'PREDICTOR=2', 'INTERLEAVE=BAND'],
+    'lzw': ['COMPRESS=LZW', 'PREDICTOR=2', 'INTERLEAVE=BAND'],
+    'raw': ['COMPRESS=NONE', 'INTERLEAVE=BAND']
+    }
+
+def codec_available(codec):
+    """ Return true if this GDAL can write GeoTIFFs with one of the codecs.
+    
+        Checks the compressions listed by the GTiff driver, which depend
+        on the GDAL version and how it was built.
+    """
+    from osgeo import gdal
+    from xml.etree.ElementTree import fromstring
+    
+    compress = codecs[codec][0].split('=', 1)[1]
+    options = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST')
+    
+    for option in fromstring(options or '<CreationOptionList/>').findall('Option'):
+        if option.get('name') == 'COMPRESS':
+            return compress in [value.text for value in option.findall('Value')]
+    
+    return False
+
+class NoData (Exception):
+    """ Raised when a slope and aspect tile has no elevation data at all.
+    """
+    pass
 
 def read_slope_aspect(filename):
     """ Return arrays of slope and aspect data (both in radians) from a filename.
+    
+        Raise NoData if the file is a stored nodata_tile.
+    """
+    slope, aspect = read_slope_aspect_bytes(filename)
+    
+    return bytes2slope(slope), bytes2aspect(aspect)
+
+def read_slope_aspect_bytes(filename):
+    """ Return arrays of 8-bit slope and aspect data as stored in a filename.
+    
+        Raise NoData if the file is a stored nodata_tile.
     """
     if not exists(filename):
         raise IOError('Missing file "%s"' % filename)
     
+    if getsize(filename) == len(nodata_tile) and open(filename, 'rb').read() == nodata_tile:
+        raise NoData('No elevation data in "%s"' % filename)
+    
+    from osgeo import gdal
+
     ds = gdal.Open(str(filename))
     
     if ds is None:
         raise IOError('Unopenable file "%s"' % filename)
     
-    slope = bytes2slope(ds.GetRasterBand(1).ReadAsArray())
-    aspect = bytes2aspect(ds.GetRasterBand(2).ReadAsArray())
+    slope = ds.GetRasterBand(1).ReadAsArray()
+    aspect = ds.GetRasterBand(2).ReadAsArray()
     
     return slope, aspect
 
-def save_slope_aspect(slope, aspect, wkt, xform, fp, tmpdir):
+def save_slope_aspect(slope, aspect, wkt, xform, fp, tmpdir, codec='jpeg'):
     """ Save arrays of slope and aspect to a GeoTIFF file pointer.
+    
+        Codec is one of the keys of codecs, default "jpeg".
     """
+    from osgeo import gdal
+
+    if codec not in codecs:
+        raise ValueError('Unknown codec "%s", not one of %s' % (codec, ', '.join(sorted(codecs))))
+
     w, h = slope.shape
     
     try:
@@ -35,8 +101,10 @@ def save_slope_aspect(slope, aspect, wkt, xform, fp, tmpdir):
         close(handle)
         
         driver = gdal.GetDriverByName('GTiff')
-        gtiff_options = ['COMPRESS=JPEG', 'JPEG_QUALITY=95', 'INTERLEAVE=BAND']
-        ds_both = driver.Create(filename, w, h, 2, gdal.GDT_Byte, gtiff_options)
+        ds_both = driver.Create(filename, w, h, 2, gdal.GDT_Byte, codecs[codec])
+        
+        if ds_both is None:
+            raise IOError('Could not create a "%s" GeoTIFF, see Hillup.codec_available()' % codec)
         
         ds_both.SetGeoTransform(xform)
         ds_both.SetProjection(wkt)
@@ -56,17 +124,33 @@ def save_slope_aspect(slope, aspect, wkt, xform, fp, tmpdir):
     finally:
         unlink(filename)
 
-def shade_hills(slope, aspect):
+#
+# Light sources combined by shade_hills(), each an azimuth and altitude
+# of the sun in degrees, a weight, and an exponent to sharpen it with.
+# By default 40% diffuse light and 60% specular, sharpened on slopes.
+#
+default_lights = (315.0, 30.0, .4, 1), (315.0, 85.0, .6, 4)
+
+def shade_hills(slope, aspect, threads=1, band_rows=256, lights=default_lights):
     """ Convert slope and aspect to 0-1 grayscale with combined light sources.
+    
+        With more than one thread, rows are shaded in bands on a thread pool.
     """
-    diffuse = shade_hills_onelight(slope, aspect, 315.0, 30.0)
-    specular = shade_hills_onelight(slope, aspect, 315.0, 85.0)
+    if threads > 1:
+        def band(top, bottom):
+            return shade_hills(slope[top:bottom], aspect[top:bottom], lights=lights),
+        
+        return map_bands(band, slope.shape[0], threads, band_rows)[0]
     
-    # sharpen specular shading on slopes
-    specular = numpy.power(specular, 4)
-
-    # 40% diffuse and 60% specular
-    shaded = .4 * diffuse + (.6 * specular)
+    shaded = 0
+    
+    for (azimuth, altitude, weight, exponent) in lights:
+        light = shade_hills_onelight(slope, aspect, azimuth, altitude)
+        
+        if exponent != 1:
+            light = numpy.power(light, exponent)
+        
+        shaded = shaded + weight * light
     
     return shaded
 
@@ -81,9 +165,52 @@ def shade_hills_onelight(slope, aspect, azimuth, altitude):
     
     return shaded
 
+def map_bands(func, rows, threads, band_rows):
+    """ Apply a function to bands of rows on a pool of threads.
+    
+        Func is called with top and bottom row numbers, and must return a
+        tuple of arrays each (bottom - top) rows tall. Return a tuple of
+        full-size arrays, each assembled from the bands in order.
+    """
+    bands = [(top, min(top + band_rows, rows)) for top in range(0, rows, band_rows)]
+    
+    def do_band(band):
+        top, bottom = band
+        return func(top, bottom)
+    
+    # numpy releases the GIL for most of the work done in func.
+    results = thread_pool(threads).map(do_band, bands)
+    
+    return tuple([numpy.concatenate(arrays) for arrays in zip(*results)])
+
+#
+# Thread pools by number of threads, see thread_pool().
+#
+thread_pools, thread_pools_pid, thread_pools_lock = {}, None, Lock()
+
+def thread_pool(threads):
+    """ Return a pool of threads, shared by everyone who asks for the same number.
+    
+        Pools are made on first use, and made again in a newly-forked
+        process where threads started by the parent no longer exist.
+    """
+    global thread_pools, thread_pools_pid, thread_pools_lock
+    
+    if thread_pools_pid != getpid():
+        thread_pools, thread_pools_pid, thread_pools_lock = {}, getpid(), Lock()
+    
+    with thread_pools_lock:
+        if threads not in thread_pools:
+            from multiprocessing.pool import ThreadPool
+            thread_pools[threads] = ThreadPool(threads)
+        
+        return thread_pools[threads]
+
 def arr2img(ar):
     """ Convert Numeric.array to PIL.Image.
     """
+    from PIL import Image
+
     return Image.fromstring('L', (ar.shape[1], ar.shape[0]), ar.astype('b').tostring())
 
 def slope2bytes(slope):
@@ -0,0 +1,268 @@
+""" Cache of 8-bit slope and aspect tiles shared by processes on one host.
+
+An ArenaCache keeps tiles in a memory-mapped file, so the worker processes
+of a pre-forked tile server, or several servers on one machine, share one
+copy of each tile instead of each reading and holding its own. Put the
+file somewhere backed by memory, such as /dev/shm on Linux.
+
+The file is a header, an index of fixed-size slots, then the slots, each
+big enough for the slope and aspect planes of one tile:
+
+    header: magic, slot count, slot size, LRU clock
+    index:  for each slot, sequence number, tile size, key hash, LRU stamp
+    slots:  slope bytes followed by aspect bytes
+
+The slot count and size are part of the file name, so caches of different
+sizes never share a file. An existing file is never truncated, because
+other processes may have it mapped and would crash on their next access.
+
+Writers hold an exclusive lock on the file and replace the slot with the
+oldest LRU stamp. Readers take no lock: a slot's sequence number is odd
+while it's being written, and a read that sees it change while copying
+throws the copy away, like a Linux seqlock.
+"""
+from os import open as os_open, close, read, lseek, fstat, ftruncate, getpid, O_RDWR, O_CREAT, SEEK_SET
+from contextlib import contextmanager
+from threading import Lock
+from hashlib import md5
+import mmap
+import fcntl
+
+import numpy
+
+from .tiles import SingleFlight
+
+magic = 'HillArn1'
+
+header_type = numpy.dtype([('magic', 'S8'), ('slots', '<u4'), ('slot_size', '<u4'), ('clock', '<u8')])
+
+index_type = numpy.dtype([('seq', '<u4'), ('height', '<u2'), ('width', '<u2'), ('hash', '<u8', (2, )), ('stamp', '<u8')])
+
+# Header and index are padded to whole pages, followed by the slots.
+page_size = mmap.PAGESIZE
+
+class ArenaCache:
+    """ ReaderCache of 8-bit slope and aspect tiles in a shared memory-mapped file.
+
+        Works like Hillup.tiles.ReaderCache, but any process that opens the
+        same path with the same max_bytes and tile_size sees the same tiles.
+        Tiles bigger than tile_size aren't kept. The file is path with the
+        slot count and slot size added, e.g. "/dev/shm/arena.256x131072".
+
+        Prefetch counts are for this process only, and tiles prefetched
+        here but evicted by another process are counted as wasted when
+        this one next puts a tile.
+    """
+    def __init__(self, path, max_bytes, tile_size=256):
+        self.max_bytes = max_bytes
+        self.slot_size = 2 * tile_size * tile_size
+        self.slots = max(1, max_bytes / self.slot_size)
+        self.path = '%s.%dx%d' % (path, self.slots, self.slot_size)
+        self.flights = SingleFlight()
+
+        # Guards prefetch counts, which are shared by threads, not processes.
+        self.lock = Lock()
+        self.pid = getpid()
+
+        self.prefetched = dict()
+        self.prefetched_bytes = 0
+        self.prefetch_hits, self.prefetch_wasted = 0, 0
+
+        index_size = _pages(header_type.itemsize) + _pages(index_type.itemsize * self.slots)
+        self.data_offset = index_size
+        file_size = index_size + self.slots * self.slot_size
+
+        with self._locked() as fd:
+            size = fstat(fd).st_size
+
+            if size == 0:
+                # New, so nobody else has it mapped yet.
+                ftruncate(fd, file_size)
+
+            elif size != file_size or _read_header(fd) != (magic, self.slots, self.slot_size):
+                raise ValueError('%s is not an arena of %d slots of %d bytes, remove it to start over' % (self.path, self.slots, self.slot_size))
+
+            self.mmap = mmap.mmap(fd, file_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+            self.header = numpy.frombuffer(self.mmap, header_type, 1, 0)
+            self.index = numpy.frombuffer(self.mmap, index_type, self.slots, _pages(header_type.itemsize))
+
+            if self.header['magic'][0] != magic:
+                self.header['slots'], self.header['slot_size'] = self.slots, self.slot_size
+                self.header['magic'] = magic
+
+    def __contains__(self, key):
+        return self._find(_hash(key)) is not None
+
+    def get(self, key):
+        """ Return slope and aspect bytes for a key, or None if they're not cached.
+        """
+        hash = _hash(key)
+
+        # A few tries, in case a writer keeps getting in the way.
+        for attempt in range(3):
+            slot = self._find(hash)
+
+            if slot is None:
+                return None
+
+            entry = self.index[slot:slot+1]
+            seq = int(entry['seq'][0])
+
+            if seq % 2:
+                continue
+
+            height, width = int(entry['height'][0]), int(entry['width'][0])
+
+            if height * width == 0:
+                planes = None, None
+            else:
+                offset = self.data_offset + slot * self.slot_size
+                data = numpy.frombuffer(self.mmap, numpy.uint8, 2 * height * width, offset).copy()
+                planes = data[:height*width].reshape(height, width), data[height*width:].reshape(height, width)
+
+            if int(entry['seq'][0]) != seq or (entry['hash'][0] != hash).any():
+                # Changed while we were copying it.
+                continue
+
+            entry['stamp'] = self._tick()
+
+            self.used(key)
+
+            return planes
+
+        return None
+
+    def used(self, key):
+        """ Count a prefetched tile as used, e.g. by a read that joined its prefetch.
+        """
+        with self._lock():
+            if key in self.prefetched:
+                self.prefetched_bytes -= self.prefetched.pop(key)
+                self.prefetch_hits += 1
+
+    def put(self, key, planes, prefetched=False):
+        """ Cache a tuple of slope and aspect bytes in the least-recently-used slot.
+        """
+        slope, aspect = planes
+        size = 0 if slope is None else slope.nbytes + aspect.nbytes
+        hash = _hash(key)
+
+        if size > self.slot_size:
+            return
+
+        with self._locked():
+            if self._find(hash) is not None:
+                return
+
+            slot = int(self.index['stamp'].argmin())
+            entry = self.index[slot:slot+1]
+
+            entry['seq'] += 1
+            entry['hash'] = hash
+
+            if slope is None:
+                entry['height'], entry['width'] = 0, 0
+            else:
+                height, width = slope.shape
+                offset = self.data_offset + slot * self.slot_size
+                data = numpy.frombuffer(self.mmap, numpy.uint8, 2 * height * width, offset)
+                data[:height*width], data[height*width:] = slope.ravel(), aspect.ravel()
+                entry['height'], entry['width'] = height, width
+
+            entry['stamp'] = self._tick()
+            entry['seq'] += 1
+
+        with self._lock():
+            if prefetched and key not in self.prefetched:
+                self.prefetched[key] = size
+                self.prefetched_bytes += size
+
+            self._forget_evicted()
+
+    def _find(self, hash):
+        """ Return the slot number with a key hash, or None.
+        """
+        found = numpy.nonzero((self.index['hash'][:,0] == hash[0]) & (self.index['hash'][:,1] == hash[1]))[0]
+
+        return int(found[0]) if len(found) else None
+
+    def _tick(self):
+        """ Return the next LRU stamp.
+
+            Processes may race and share a stamp, which does no harm.
+        """
+        self.header['clock'] += 1
+        return self.header['clock'][0]
+
+    def _forget_evicted(self):
+        """ Count prefetched tiles no longer anywhere in the arena as wasted.
+
+            Call with the lock held, see _lock().
+        """
+        if not self.prefetched:
+            return
+
+        for key in self.prefetched.keys():
+            if self._find(_hash(key)) is None:
+                self.prefetched_bytes -= self.prefetched.pop(key)
+                self.prefetch_wasted += 1
+
+    def _lock(self):
+        """ Return the thread lock, or a new one in a newly-forked process.
+
+            Like Hillup.tiles.ReaderCache, a thread in the parent might
+            have held the old one at the time.
+        """
+        if self.pid != getpid():
+            self.pid, self.lock = getpid(), Lock()
+
+        return self.lock
+
+    @contextmanager
+    def _locked(self):
+        """ Hold an exclusive lock on the arena file.
+
+            The file is opened fresh each time, because flock() locks are
+            shared by forked processes with the same open file. It's also
+            unlocked explicitly, because mmap keeps its own duplicate.
+        """
+        fd = os_open(self.path, O_RDWR | O_CREAT, 0666)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            close(fd)
+
+def _hash(key):
+    """ Return a key hash as an array of two 64-bit integers, never both zero.
+
+        Kept in numpy types throughout, since mixing them with Python
+        longs goes by way of floating point and loses precision.
+    """
+    hash = numpy.frombuffer(md5(repr(key)).digest(), '<u8').copy()
+
+    # all-zero is an empty slot.
+    hash[0] = hash[0] or 1
+
+    return hash
+
+def _pages(size):
+    """ Return a size rounded up to whole pages.
+    """
+    return page_size * ((size + page_size - 1) / page_size)
+
+def _read_header(fd):
+    """ Return magic, slot count and slot size from an arena file descriptor.
+    """
+    lseek(fd, 0, SEEK_SET)
+    data = read(fd, header_type.itemsize)
+
+    if len(data) < header_type.itemsize:
+        return None
+
+    header = numpy.frombuffer(data, header_type)[0]
+
+    return header['magic'], int(header['slots']), int(header['slot_size'])
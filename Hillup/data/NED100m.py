@@ -2,15 +2,16 @@
 """
 from sys import stderr
 from math import floor, ceil, log
-from os import unlink, close, write, makedirs, chmod
-from os.path import basename, exists, isdir, join
+from os.path import basename, join
 from httplib import HTTPConnection
 from urlparse import urlparse
 from StringIO import StringIO
 from gzip import GzipFile
 from hashlib import md5
 
-from TileStache.Geography import SphericalMercator
+from . import coverage
+from .coverage import MISSING
+from .files import local_dem, download_dir, ingest
 
 from osgeo import gdal, osr
 
@@ -36,18 +37,13 @@ def quads(minlon, minlat, maxlon, maxlat):
     
         lon += 1
 
-def datasource(lat, lon, source_dir):
-    """ Return a gdal datasource for a NED 10m lat, lon corner.
-    
-        If it doesn't already exist locally in source_dir, grab a new one.
+def locate(lat, lon, source_dir):
+    """ Return remote URL, local DEM path and local 404 path for a NED100m lat, lon corner.
     """
     # FIXME for southern/western hemispheres
     fmt = 'http://ned.stamen.com/100m/n%02dw%03d.tif.gz'
     url = fmt % (abs(lat), abs(lon))
     
-    #
-    # Create a local filepath
-    #
     s, host, path, p, q, f = urlparse(url)
     
     local_dir = md5(url).hexdigest()[:3]
@@ -57,20 +53,26 @@ def datasource(lat, lon, source_dir):
     local_path = local_base + '.tif'
     local_none = local_base + '.404'
     
-    #
-    # Check if the file exists locally
-    #
-    if exists(local_path):
-        return gdal.Open(local_path, gdal.GA_ReadOnly)
+    return url, local_path, local_none
 
-    if exists(local_none):
+def datasource(lat, lon, source_dir):
+    """ Return a gdal datasource for a NED 100m lat, lon corner.
+    
+        If it doesn't already exist locally in source_dir, grab a new one.
+    """
+    index = coverage.index(source_dir, 'NED100m')
+    
+    dem_file = local_dem(lat, lon, source_dir, index, locate, download)
+    
+    if not dem_file:
         return None
 
-    if not exists(local_dir):
-        makedirs(local_dir)
-        chmod(local_dir, 0777)
-    
-    assert isdir(local_dir)
+    return gdal.Open(dem_file, gdal.GA_ReadOnly)
+
+def download(url, local_path):
+    """ Download a remote NED100m DEM to a local path, return False if it's not found.
+    """
+    s, host, path, p, q, f = urlparse(url)
     
     #
     # Grab a fresh remote copy
@@ -83,24 +85,29 @@ def datasource(lat, lon, source_dir):
     
     if resp.status in range(400, 500):
         # we're probably outside the coverage area
-        print >> open(local_none, 'w'), url
-        return None
+        return False
     
     assert resp.status == 200, (resp.status, resp.read())
     
     body = StringIO(resp.read())
     file = GzipFile(fileobj=body, mode='r')
     
-    open(local_path, mode='w').write(file.read())
+    with download_dir(local_path) as dirpath:
+        dem_file = open(join(dirpath, basename(local_path)), 'w')
+        dem_file.write(file.read())
+        dem_file.close()
+        
+        ingest(local_path, dirpath)
     
-    #
-    # The file better exist locally now
-    #
-    return gdal.Open(local_path, gdal.GA_ReadOnly)
+    return True
 
 def datasources(minlon, minlat, maxlon, maxlat, source_dir):
     """ Retrieve a list of SRTM1 datasources overlapping the tile coordinate.
     """
+    index = coverage.index(source_dir, 'NED100m')
+    index.refresh()
+    
     lonlats = quads(minlon, minlat, maxlon, maxlat)
+    lonlats = [(lon, lat) for (lon, lat) in lonlats if index.state(lat, lon) != MISSING]
     sources = [datasource(lat, lon, source_dir) for (lon, lat) in lonlats]
     return [ds for ds in sources if ds]
@@ -2,17 +2,17 @@
 """
 from sys import stderr
 from math import floor, ceil, log
-from os import unlink, close, write, makedirs, chmod
-from os.path import basename, exists, isdir, join
-from tempfile import mkstemp, mkdtemp
+from os import rename
+from os.path import basename, join
 from httplib import HTTPConnection
-from shutil import move, rmtree
 from urlparse import urlparse
 from zipfile import ZipFile
 from fnmatch import fnmatch
 from hashlib import md5
 
-from TileStache.Geography import SphericalMercator
+from . import coverage
+from .coverage import MISSING
+from .files import local_dem, download_dir, ingest
 
 from osgeo import gdal, osr
 
@@ -38,22 +38,17 @@ def quads(minlon, minlat, maxlon, maxlat):
     
         lon += 1
 
-def datasource(lat, lon, source_dir):
-    """ Return a gdal datasource for a NED 10m lat, lon corner.
-    
-        If it doesn't already exist locally in source_dir, grab a new one.
+def locate(lat, lon, source_dir):
+    """ Return remote URL, local DEM path and local 404 path for a NED10m lat, lon corner.
     """
     #
-    # Create a URL - tdds3.cr.usgs.gov looks to be a redirect from
+    # tdds3.cr.usgs.gov looks to be a redirect from
     # http://gisdata.usgs.gov/TDDS/DownloadFile.php?TYPE=ned3f_zip&FNAME=nxxwxx.zip
     #
     # FIXME for southern/western hemispheres
     fmt = 'http://tdds3.cr.usgs.gov/Ortho9/ned/ned_13/float/n%02dw%03d.zip'
     url = fmt % (abs(lat), abs(lon))
     
-    #
-    # Create a local filepath
-    #
     s, host, path, p, q, f = urlparse(url)
     
     local_dir = md5(url).hexdigest()[:3]
@@ -63,20 +58,27 @@ def datasource(lat, lon, source_dir):
     local_path = local_base + '.flt'
     local_none = local_base + '.404'
     
-    #
-    # Check if the file exists locally
-    #
-    if exists(local_path):
-        return gdal.Open(local_path, gdal.GA_ReadOnly)
+    return url, local_path, local_none
 
-    if exists(local_none):
+def datasource(lat, lon, source_dir):
+    """ Return a gdal datasource for a NED 10m lat, lon corner.
+    
+        If it doesn't already exist locally in source_dir, grab a new one.
+    """
+    index = coverage.index(source_dir, 'NED10m')
+    
+    dem_file = local_dem(lat, lon, source_dir, index, locate, download)
+    
+    if not dem_file:
         return None
 
-    if not exists(local_dir):
-        makedirs(local_dir)
-        chmod(local_dir, 0777)
-    
-    assert isdir(local_dir)
+    return gdal.Open(dem_file, gdal.GA_ReadOnly)
+
+def download(url, local_path):
+    """ Download a remote NED 10m DEM to a local path, return False if it's not found.
+    """
+    s, host, path, p, q, f = urlparse(url)
+    local_base = local_path[:-4]
     
     #
     # Grab a fresh remote copy
@@ -89,13 +91,11 @@ def datasource(lat, lon, source_dir):
     
     if resp.status == 404:
         # we're probably outside the coverage area
-        print >> open(local_none, 'w'), url
-        return None
+        return False
     
     assert resp.status == 200, (resp.status, resp.read())
     
-    try:
-        dirpath = mkdtemp(prefix='ned10m-')
+    with download_dir(local_path) as dirpath:
         zippath = join(dirpath, 'dem.zip')
 
         zipfile = open(zippath, 'w')
@@ -103,41 +103,46 @@ def datasource(lat, lon, source_dir):
         zipfile.close()
 
         zipfile = ZipFile(zippath)
+        extracted = {}
         
         for name in zipfile.namelist():
             if fnmatch(name, '*/*/float*.???') and name[-4:] in ('.hdr', '.flt', '.prj'):
-                local_file = local_base + name[-4:]
+                ext = name[-4:]
 
             elif fnmatch(name, '*/float*_13.???') and name[-4:] in ('.hdr', '.flt', '.prj'):
-                local_file = local_base + name[-4:]
+                ext = name[-4:]
 
             elif fnmatch(name, '*/float*_13'):
-                local_file = local_base + '.flt'
+                ext = '.flt'
 
             else:
                 # don't recognize the contents of this zip file
                 continue
             
             zipfile.extract(name, dirpath)
-            move(join(dirpath, name), local_file)
+            extracted[ext] = join(dirpath, name)
             
-            if local_file.endswith('.hdr'):
+            if ext == '.hdr':
                 # GDAL needs some extra hints to understand the raw float data
-                hdr_file = open(local_file, 'a')
+                hdr_file = open(extracted[ext], 'a')
                 print >> hdr_file, 'nbits 32'
                 print >> hdr_file, 'pixeltype float'
+                hdr_file.close()
         
-        #
-        # The file better exist locally now
-        #
-        return gdal.Open(local_path, gdal.GA_ReadOnly)
+        for (ext, extracted_path) in extracted.items():
+            rename(extracted_path, join(dirpath, basename(local_base + ext)))
+        
+        ingest(local_path, dirpath)
     
-    finally:
-        rmtree(dirpath)
+    return True
 
 def datasources(minlon, minlat, maxlon, maxlat, source_dir):
     """ Retrieve a list of SRTM1 datasources overlapping the tile coordinate.
     """
+    index = coverage.index(source_dir, 'NED10m')
+    index.refresh()
+    
     lonlats = quads(minlon, minlat, maxlon, maxlat)
+    lonlats = [(lon, lat) for (lon, lat) in lonlats if index.state(lat, lon) != MISSING]
     sources = [datasource(lat, lon, source_dir) for (lon, lat) in lonlats]
     return [ds for ds in sources if ds]
@@ -53,15 +53,15 @@
 """
 from sys import stderr
 from math import floor, log
-from os import unlink, close, write, chmod, makedirs
-from os.path import basename, exists, isdir, join
+from os.path import basename, join
 from httplib import HTTPConnection
 from urlparse import urlparse
-from tempfile import mkstemp
 from zipfile import ZipFile
 from hashlib import md5
 
-from TileStache.Geography import SphericalMercator
+from . import coverage
+from .coverage import MISSING
+from .files import local_dem, download_dir, ingest
 
 from osgeo import gdal, osr
 
@@ -160,26 +160,14 @@ def quads(minlon, minlat, maxlon, maxlat):
     
         lon += 1
 
-def datasource(lat, lon, source_dir):
-    """ Return a gdal datasource for an SRTM3 lat, lon corner.
+def locate(lat, lon, source_dir):
+    """ Return remote URL, local DEM path and local 404 path for an SRTM3 lat, lon corner.
     
-        If it doesn't already exist locally in source_dir, grab a new one.
+        Raise ValueError for locations outside a known region.
     """
-    #
-    # Create a URL
-    #
-    try:
-        reg = region(lat, lon)
-    except ValueError:
-        # we're probably outside a known region
-        return None
-
     fmt = 'http://dds.cr.usgs.gov/srtm/version2_1/SRTM3/%s/%s.hgt.zip'
-    url = fmt % (reg, filename(lat, lon))
+    url = fmt % (region(lat, lon), filename(lat, lon))
     
-    #
-    # Create a local filepath
-    #
     s, host, path, p, q, f = urlparse(url)
     
     dem_dir = md5(url).hexdigest()[:3]
@@ -188,20 +176,26 @@ def datasource(lat, lon, source_dir):
     dem_path = join(dem_dir, basename(path)[:-4])
     dem_none = dem_path[:-4]+'.404'
     
-    #
-    # Check if the file exists locally
-    #
-    if exists(dem_path):
-        return gdal.Open(dem_path, gdal.GA_ReadOnly)
+    return url, dem_path, dem_none
 
-    if exists(dem_none):
+def datasource(lat, lon, source_dir):
+    """ Return a gdal datasource for an SRTM3 lat, lon corner.
+    
+        If it doesn't already exist locally in source_dir, grab a new one.
+    """
+    index = coverage.index(source_dir, 'SRTM3')
+    
+    dem_file = local_dem(lat, lon, source_dir, index, locate, download)
+    
+    if not dem_file:
         return None
 
-    if not exists(dem_dir):
-        makedirs(dem_dir)
-        chmod(dem_dir, 0777)
-    
-    assert isdir(dem_dir)
+    return gdal.Open(dem_file, gdal.GA_ReadOnly)
+
+def download(url, dem_path):
+    """ Download a remote SRTM3 DEM to a local path, return False if it's not found.
+    """
+    s, host, path, p, q, f = urlparse(url)
     
     #
     # Grab a fresh remote copy
@@ -214,42 +208,38 @@ def datasource(lat, lon, source_dir):
     
     if resp.status == 404:
         # we're probably outside the coverage area
-        print >> open(dem_none, 'w'), url
-        return None
+        return False
     
     assert resp.status == 200, (resp.status, resp.read())
     
-    try:
+    with download_dir(dem_path) as dirpath:
+        zip_path = join(dirpath, 'download.zip')
+        
+        zip_file = open(zip_path, 'w')
+        zip_file.write(resp.read())
+        zip_file.close()
+        
         #
         # Get the DEM out of the zip file
         #
-        handle, zip_path = mkstemp(prefix='srtm3-', suffix='.zip')
-        write(handle, resp.read())
-        close(handle)
-        
         zipfile = ZipFile(zip_path, 'r')
         
-        #
-        # Write the actual DEM
-        #
-        dem_file = open(dem_path, 'w')
+        dem_file = open(join(dirpath, basename(dem_path)), 'w')
         dem_file.write(zipfile.read(zipfile.namelist()[0]))
         dem_file.close()
         
-        chmod(dem_path, 0666)
-    
-    finally:
-        unlink(zip_path)
+        ingest(dem_path, dirpath, zip_path)
 
-    #
-    # The file better exist locally now
-    #
-    return gdal.Open(dem_path, gdal.GA_ReadOnly)
+    return True
 
 def datasources(minlon, minlat, maxlon, maxlat, source_dir):
     """ Retrieve a list of SRTM3 datasources overlapping the tile coordinate.
     """
+    index = coverage.index(source_dir, 'SRTM3')
+    index.refresh()
+    
     lonlats = quads(minlon, minlat, maxlon, maxlat)
+    lonlats = [(lon, lat) for (lon, lat) in lonlats if index.state(lat, lon) != MISSING]
     sources = [datasource(lat, lon, source_dir) for (lon, lat) in lonlats]
     return [ds for ds in sources if ds]
 
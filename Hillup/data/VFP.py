@@ -1,25 +1,24 @@
 from sys import stderr
 from urlparse import urlparse, urljoin
-from os import unlink, close, write, chmod, makedirs
-from os.path import basename, exists, isdir, join
+from os.path import basename, join
 from httplib import HTTPConnection
-from tempfile import mkstemp
 from zipfile import ZipFile
 from hashlib import md5
 
 from .SRTM3 import sref, quads, filename, datasource as srtm3_datasource
 
+from . import coverage
+from .coverage import MISSING
+from .files import local_dem, download_dir, ingest
+
 from osgeo import gdal
 
-def datasource(lat, lon, source_dir):
-    """
+def locate(lat, lon, source_dir):
+    """ Return remote URL, local DEM path and local 404 path for a VFP lat, lon corner.
     """
     fmt = 'http://viewfinderpanos-index.herokuapp.com/index.php/%s.hgt'
     url = fmt % filename(lat, lon)
     
-    #
-    # Create a local filepath
-    #
     s, host, path, p, q, f = urlparse(url)
     
     dem_dir = md5(url).hexdigest()[:3]
@@ -28,20 +27,24 @@ def datasource(lat, lon, source_dir):
     dem_path = join(dem_dir, basename(path))
     dem_none = dem_path[:-4]+'.404'
     
-    #
-    # Check if the file exists locally
-    #
-    if exists(dem_path):
-        return gdal.Open(dem_path, gdal.GA_ReadOnly)
+    return url, dem_path, dem_none
 
-    if exists(dem_none):
+def datasource(lat, lon, source_dir):
+    """
+    """
+    index = coverage.index(source_dir, 'VFP')
+    
+    dem_file = local_dem(lat, lon, source_dir, index, locate, download)
+    
+    if not dem_file:
         return None
 
-    if not exists(dem_dir):
-        makedirs(dem_dir)
-        chmod(dem_dir, 0777)
-    
-    assert isdir(dem_dir)
+    return gdal.Open(dem_file, gdal.GA_ReadOnly)
+
+def download(url, dem_path):
+    """ Download a remote VFP DEM to a local path, return False if it's not found.
+    """
+    s, host, path, p, q, f = urlparse(url)
     
     #
     # Grab a fresh remote copy
@@ -54,8 +57,7 @@ def datasource(lat, lon, source_dir):
     
     if resp.status == 404:
         # we're probably outside the coverage area, use SRTM3 instead
-        print >> open(dem_none, 'w'), url
-        return None
+        return False
     
     print >> stderr, 'Found', resp.getheader('location'), 'X-Zip-Path:', resp.getheader('x-zip-path')
 
@@ -77,38 +79,36 @@ def datasource(lat, lon, source_dir):
     
     assert resp.status in range(200, 299), (resp.status, resp.read())
     
-    try:
+    with download_dir(dem_path) as dirpath:
+        zip_path = join(dirpath, 'download.zip')
+        
+        zip_file = open(zip_path, 'w')
+        zip_file.write(resp.read())
+        zip_file.close()
+        
         #
         # Get the DEM out of the zip file
         #
-        handle, zip_path = mkstemp(prefix='vfp-', suffix='.zip')
-        write(handle, resp.read())
-        close(handle)
-        
         zipfile = ZipFile(zip_path, 'r')
         
-        #
-        # Write the actual DEM
-        #
         print >> stderr, 'Extracting', zip_filepath, 'to', dem_path
-    
-        dem_file = open(dem_path, 'w')
+        
+        dem_file = open(join(dirpath, basename(dem_path)), 'w')
         dem_file.write(zipfile.read(zip_filepath))
         dem_file.close()
         
-        chmod(dem_path, 0666)
-    
-    finally:
-        unlink(zip_path)
+        # archives cover many quads, so never keep them as they are.
+        ingest(dem_path, dirpath)
 
-    #
-    # The file better exist locally now
-    #
-    return gdal.Open(dem_path, gdal.GA_ReadOnly)
+    return True
 
 def datasources(minlon, minlat, maxlon, maxlat, source_dir):
     """ Retrieve a list of VFP or SRTM3 datasources overlapping the tile coordinate.
     """
+    index = coverage.index(source_dir, 'VFP')
+    index.refresh()
+    
     lonlats = quads(minlon, minlat, maxlon, maxlat)
+    lonlats = [(lon, lat) for (lon, lat) in lonlats if index.state(lat, lon) != MISSING]
     sources = [datasource(lat, lon, source_dir) for (lon, lat) in lonlats]
     return [ds for ds in sources if ds]
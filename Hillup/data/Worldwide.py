@@ -1,6 +1,7 @@
 from .SRTM3 import sref, quads
 from .SRTM3 import datasource as srtm3_datasource
 from .VFP import datasource as vfp_datasource
+from . import coverage
 
 def datasource(lat, lon, source_dir):
     '''
@@ -15,6 +16,9 @@ def datasource(lat, lon, source_dir):
 def datasources(minlon, minlat, maxlon, maxlat, source_dir):
     """ Retrieve a list of VFP or SRTM3 datasources overlapping the tile coordinate.
     """
+    coverage.index(source_dir, 'VFP').refresh()
+    coverage.index(source_dir, 'SRTM3').refresh()
+    
     lonlats = quads(minlon, minlat, maxlon, maxlat)
     sources = [datasource(lat, lon, source_dir) for (lon, lat) in lonlats]
     return [ds for ds in sources if ds]
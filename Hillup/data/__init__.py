@@ -1,68 +1,183 @@
 """ Starting point for DEM retrieval utilities.
 """
 from math import pi, sin, cos
-from os import unlink, close
+from os import unlink, close, rename
+from os.path import dirname, exists, join
+from hashlib import md5
 from itertools import product
 from tempfile import mkstemp
 from sys import modules
+from StringIO import StringIO
 
-import NED10m, NED100m, NED1km, SRTM1, SRTM3, VFP, Worldwide
-
-from ModestMaps.Core import Coordinate
 from TileStache.Geography import SphericalMercator
 from TileStache.Core import Layer, Metatile
-from TileStache.Config import Configuration
-from TileStache.Caches import Disk
 
-from osgeo import gdal, osr
-from PIL import Image
 import numpy
 
-from .. import save_slope_aspect
+from .. import save_slope_aspect, map_bands, nodata_tile, codecs, codec_available, default_lights
+from .files import make_dir
 
 # used to prevent clobbering in /vsimem/, see:
 # http://osgeo-org.1803224.n2.nabble.com/gdal-dev-Outputting-to-vsimem-td6221295.html
 vsimem_counter = 1
 
 #
-# Set up some useful projections.
+# Resampling for each quality tier, as a list of (highest zoom, squeezing,
+# stretching) zoom ranges. Squeezing is when there are more DEM samples than
+# output pixels. Cubic looks better squeezing down and cubic spline looks
+# better stretching out, but bilinear is much faster and looks the same
+# once shaded and quantized to 8 bits at low zooms.
 #
+quality_tiers = {
+    'high': [(None, 'Cubic', 'CubicSpline')],
+    'normal': [(10, 'Bilinear', 'Bilinear'), (None, 'Cubic', 'CubicSpline')],
+    'draft': [(None, 'NearestNeighbour', 'Bilinear')]
+    }
 
-osr.UseExceptions() # <-- otherwise errors will be silent and useless.
+#
+# Set up some useful projections. GDAL and the DEM modules are only
+# imported on first use, so that importing this module stays cheap.
+#
 
 webmerc_proj = SphericalMercator()
-webmerc_sref = osr.SpatialReference()
-webmerc_sref.ImportFromProj4(webmerc_proj.srs)
+
+_webmerc_sref = None
+
+def webmerc_sref():
+    """ Return an OSR spatial reference for spherical mercator.
+    """
+    global _webmerc_sref
+    
+    if _webmerc_sref is None:
+        from osgeo import osr
+        
+        osr.UseExceptions() # <-- otherwise errors will be silent and useless.
+
+        _webmerc_sref = osr.SpatialReference()
+        _webmerc_sref.ImportFromProj4(webmerc_proj.srs)
+    
+    return _webmerc_sref
+
+def dem_module(name):
+    """ Return a DEM module such as SRTM3 or NED10m by name, imported on first use.
+    """
+    modname = '%s.%s' % (__name__, name)
+
+    __import__(modname)
+    return modules[modname]
+
+def choose_resampling(quality, zoom, squeezing):
+    """ Return the name of a GDAL resampling method for a quality tier and zoom.
+    
+        Squeezing is true when the source DEM has more samples than output pixels.
+    """
+    for (highest_zoom, squeeze, stretch) in quality_tiers[quality]:
+        if highest_zoom is None or zoom <= highest_zoom:
+            return squeezing and squeeze or stretch
 
 class SeedingLayer (Layer):
     """ Tilestache-compatible seeding layer for preparing tiled data.
     
         Intended for use in hillup-seed.py script for preparing a tile directory.
     """
-    def __init__(self, demdir, tiledir, tmpdir, source, size):
-        """
+    def __init__(self, demdir, tiledir, tmpdir, source, size, threads=1, dedup=False, quality='high', warpdir=None, codec='jpeg', pngdir=None, lights=default_lights):
+        """ Optional dedup flag stores identical tiles only once, see DedupDisk.
+        
+            Quality is a key of quality_tiers, warpdir is an optional
+            directory for warped elevation, and codec is a key of
+            Hillup.codecs, all described in Provider.
+            
+            Optional pngdir is a directory for shaded PNG tiles made in the
+            same pass, laid out like a TileStache disk cache for one layer,
+            and lights are used to shade them as in Hillup.tiles.Provider.
         """
-        cache = Disk(tiledir, dirs='safe')
+        from TileStache.Config import Configuration
+        from TileStache.Caches import Disk
+        from ..tiles import get_style
+        from .dedup import DedupDisk
+        
+        if dedup:
+            cache = DedupDisk(tiledir, dirs='safe')
+        else:
+            cache = Disk(tiledir, dirs='safe')
+        
+        if pngdir is None:
+            self.png_cache = None
+        elif dedup:
+            self.png_cache = DedupDisk(pngdir, dirs='safe')
+        else:
+            self.png_cache = Disk(pngdir, dirs='safe')
+        
         config = Configuration(cache, '.')
         Layer.__init__(self, config, SphericalMercator(), Metatile(), tile_height=size)
         
-        self.provider = Provider(self, demdir, tmpdir, source)
+        self.provider = Provider(self, demdir, tmpdir, source, threads, quality, warpdir, codec)
+        self.lights = get_style(lights).lights
 
     def name(self):
         return '.'
 
+    def render(self, coord, format):
+        """ Render a slope and aspect tile, and save a shaded PNG if there's a pngdir.
+        
+            The PNG is shaded straight from unquantized slope and aspect,
+            so it doesn't need to be read back and decoded from the GeoTIFF.
+        """
+        tile = Layer.render(self, coord, format)
+        
+        if self.png_cache is not None:
+            from ..tiles import shade_tile, shaded_image, flat_tile
+            
+            if isinstance(tile, EmptySlopeAndAspect):
+                image = flat_tile(self.dim, self.dim)
+            else:
+                image = shaded_image(shade_tile(tile.slope, tile.aspect, self.provider.threads, self.lights))
+            
+            buff = StringIO()
+            image.save(buff, 'PNG')
+            self.png_cache.save(buff.getvalue(), self, coord, 'PNG')
+        
+        return tile
+
 class Provider:
     """ TileStache provider for generating tiles of DEM slope and aspect data.
     
         Source parameter can be "srtm-ned" (default) or "ned-only".
+        
+        Threads parameter is the number of threads used to calculate
+        slope and aspect, useful for very large tile sizes.
+        
+        Quality parameter is "high" (default), "normal" or "draft", choosing
+        faster resampling of DEMs at more zoom levels, see quality_tiers.
+        
+        Warpdir parameter is an optional directory where each DEM module's
+        warped elevation is kept at zoom levels that blend two modules, so
+        that rendering the same area again needs no warping, even when the
+        blend proportions have changed. Clear it if DEM files change.
+        
+        Codec parameter is the compression of slope and aspect GeoTIFFs:
+        "jpeg" (default), "deflate", "zstd", "lzw" or "raw", see Hillup.codecs.
 
         See http://tilestache.org/doc/#custom-providers for information
         on how the Provider object interacts with TileStache.
     """
-    def __init__(self, layer, demdir, tmpdir=None, source='srtm-ned'):
+    def __init__(self, layer, demdir, tmpdir=None, source='srtm-ned', threads=1, quality='high', warpdir=None, codec='jpeg'):
+        if quality not in quality_tiers:
+            raise ValueError('Unknown quality "%s", not one of %s' % (quality, ', '.join(sorted(quality_tiers))))
+        
+        if codec not in codecs:
+            raise ValueError('Unknown codec "%s", not one of %s' % (codec, ', '.join(sorted(codecs))))
+        
+        if not codec_available(codec):
+            raise ValueError('Codec "%s" is not supported by this GDAL, which needs %s in its GTiff driver' % (codec, codecs[codec][0]))
+        
         self.tmpdir = tmpdir
         self.demdir = demdir
         self.source = source
+        self.threads = threads
+        self.quality = quality
+        self.warpdir = warpdir
+        self.codec = codec
     
     def getTypeByExtension(self, ext):
         if ext.lower() != 'tiff':
@@ -72,25 +187,14 @@ class Provider:
     
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """ Return an instance of SlopeAndAspect for requested area.
-        """
-        assert srs == webmerc_proj.srs # <-- good enough for now
-        
-        if self.source == 'srtm-ned':
-            providers = choose_providers_srtm(zoom)
         
-        elif self.source == 'ned-only':
-            providers = choose_providers_ned(zoom)
-
-        elif self.source == 'vfp':
-            providers = [(VFP, 1)]
-
-        elif self.source == 'worldwide':
-            providers = [(Worldwide, 1)]
+            Return an EmptySlopeAndAspect if there is no elevation data.
+        """
+        from osgeo import gdal, osr
 
-        else:
-            providers = load_func_path(self.source)(zoom)
+        assert srs == webmerc_proj.srs # <-- good enough for now
         
-        assert sum([proportion for (mod, proportion) in providers]) == 1.0
+        providers = choose_providers(self.source, zoom)
         
         #
         # Prepare information for datasets of the desired extent and projection.
@@ -99,81 +203,116 @@ class Provider:
         xres = (xmax - xmin) / width
         yres = (ymin - ymax) / height
 
-        area_wkt = webmerc_sref.ExportToWkt()
+        area_wkt = webmerc_sref().ExportToWkt()
         buffered_xform = xmin - xres, xres, 0, ymax - yres, 0, yres
         
         #
         # Reproject and merge DEM datasources into destination datasets.
         #
         
-        driver = gdal.GetDriverByName('GTiff')
-        
-        composite_ds = make_empty_datasource(width+2, height+2, buffered_xform, area_wkt, self.tmpdir)
+        composite_ds = None
         proportion_complete = 0.
+        
+        #
+        # Elevation is the blended result so far, and layer is a single
+        # scratch buffer reused for each additional module after the first.
+        #
+        elevation, layer = None, None
+
+        # blended zooms keep each module's warped elevation for reuse.
+        warp_cache = self.warpdir is not None and len(providers) > 1
 
         for (module, proportion) in providers:
         
-            cs2cs = osr.CoordinateTransformation(webmerc_sref, module.sref)
+            if warp_cache:
+                cache_path = warped_path(self.warpdir, module, self.quality, zoom, width, height, xmin, ymin, xmax, ymax)
+                
+                if exists(cache_path):
+                    warped = numpy.load(cache_path)
+                    
+                    if elevation is None:
+                        elevation = warped
+                    
+                    else:
+                        proportion_with = proportion / (proportion_complete + proportion)
+                        blend_elevation(elevation, warped, proportion_with, -9999)
+                    
+                    proportion_complete += proportion
+                    continue
+        
+            cs2cs = osr.CoordinateTransformation(webmerc_sref(), module.sref)
             
             # get a lat/lon bbox buffered by one pixel on all sides
             minlon, minlat, z = cs2cs.TransformPoint(xmin - xres, ymin + yres)
             maxlon, maxlat, z = cs2cs.TransformPoint(xmax + xres, ymax - yres)
             
-            #
-            # Keep a version of the composite without the
-            # current layer applied for later alpha-blending.
-            #
-            do_blending = bool(proportion_complete > 0 and proportion < 1)
+            ds_args = minlon, minlat, maxlon, maxlat, self.demdir
+            ds_dems = module.datasources(*ds_args)
             
-            if do_blending:
-                composite_without = composite_ds.ReadAsArray()
+            if not ds_dems:
+                # no coverage from this module here, e.g. over oceans.
+                proportion_complete += proportion
+                continue
             
-            ds_args = minlon, minlat, maxlon, maxlat, self.demdir
+            if composite_ds is None:
+                composite_ds = make_empty_datasource(width+2, height+2, buffered_xform, area_wkt, self.tmpdir)
+                composite_band = composite_ds.GetRasterBand(1)
+            
+            else:
+                # start each additional module from a clean slate.
+                composite_band.Fill(-9999)
             
-            for ds_dem in module.datasources(*ds_args):
+            for ds_dem in ds_dems:
             
                 # estimate the raster density across source DEM and output
                 dem_samples = (maxlon - minlon) / ds_dem.GetGeoTransform()[1]
                 area_pixels = (xmax - xmin) / composite_ds.GetGeoTransform()[1]
                 
-                if dem_samples > area_pixels:
-                    # cubic looks better squeezing down
-                    resample = gdal.GRA_Cubic
-                else:
-                    # cubic spline looks better stretching out
-                    resample = gdal.GRA_CubicSpline
+                resampling = choose_resampling(self.quality, zoom, dem_samples > area_pixels)
+                resample = getattr(gdal, 'GRA_' + resampling)
 
                 gdal.ReprojectImage(ds_dem, composite_ds, ds_dem.GetProjection(), composite_ds.GetProjection(), resample)
-                ds_dem = None
+            
+            ds_dem, ds_dems = None, None
             
             #
             # Perform alpha-blending if needed.
             #
-            if do_blending:
-                proportion_with = proportion / (proportion_complete + proportion)
-                proportion_without = 1 - proportion_with
+            if elevation is None:
+                elevation = composite_band.ReadAsArray()
                 
-                composite_with = composite_ds.ReadAsArray() * proportion_with
-                composite_with += composite_without * proportion_without
-
-                composite_ds.GetRasterBand(1).WriteArray(composite_with, 0, 0)
+                if warp_cache:
+                    save_warped(cache_path, elevation)
             
-            proportion_complete += proportion
+            else:
+                layer = composite_band.ReadAsArray(buf_obj=layer)
                 
-        elevation = composite_ds.ReadAsArray()
-
-        unlink(composite_ds.GetFileList()[0])
-        composite_ds = None
+                if warp_cache:
+                    save_warped(cache_path, layer)
+                
+                proportion_with = proportion / (proportion_complete + proportion)
+                blend_elevation(elevation, layer, proportion_with, -9999)
+            
+            proportion_complete += proportion
+        
+        if composite_ds is not None:
+            composite_band = None
+            unlink(composite_ds.GetFileList()[0])
+            composite_ds = None
+        
+        if elevation is None or (elevation == -9999).all():
+            # Nothing to see here, skip slope, aspect and GeoTIFF encoding.
+            return EmptySlopeAndAspect()
         
         #
         # Calculate and save slope and aspect.
         #
         
-        slope, aspect = calculate_slope_aspect(elevation, xres, yres)
+        slope, aspect = calculate_slope_aspect(elevation, xres, yres, threads=self.threads)
 
         tile_xform = xmin, xres, 0, ymax, 0, yres
         
-        return SlopeAndAspect(self.tmpdir, slope, aspect, area_wkt, tile_xform)
+        return SlopeAndAspect(self.tmpdir, slope, aspect, area_wkt, tile_xform, self.codec)
 
 class SlopeAndAspect:
     """ TileStache response object with PIL-like save() and crop() methods.
@@ -183,10 +322,11 @@ class SlopeAndAspect:
         See http://tilestache.org/doc/#custom-providers for information
         on how the SlopeAndAspect object interacts with TileStache.
     """
-    def __init__(self, tmpdir, slope, aspect, wkt, xform):
+    def __init__(self, tmpdir, slope, aspect, wkt, xform, codec='jpeg'):
         """ Instantiate with array of slope and aspect, and minimal geographic information.
         """
         self.tmpdir = tmpdir
+        self.codec = codec
         
         self.slope = slope
         self.aspect = aspect
@@ -202,7 +342,7 @@ class SlopeAndAspect:
         if format != 'TIFF':
             raise Exception('File format other than TIFF for slope and aspect: "%s"' % format)
         
-        save_slope_aspect(self.slope, self.aspect, self.wkt, self.xform, output, self.tmpdir)
+        save_slope_aspect(self.slope, self.aspect, self.wkt, self.xform, output, self.tmpdir, self.codec)
     
     def crop(self, box):
         """ Returns a rectangular region from the current image.
@@ -212,12 +352,59 @@ class SlopeAndAspect:
         """
         raise NotImplementedError()
 
+class EmptySlopeAndAspect:
+    """ TileStache response object for an area with no elevation data at all.
+    
+        Saves a short sentinel string instead of a GeoTIFF, the same for
+        every empty tile. Hillup.tiles.render_tile() knows to treat it as
+        flat ground.
+    """
+    def save(self, output, format):
+        """ Save the sentinel to output file-like object.
+        """
+        if format != 'TIFF':
+            raise Exception('File format other than TIFF for slope and aspect: "%s"' % format)
+        
+        output.write(nodata_tile)
+    
+    def crop(self, box):
+        """ Returns a rectangular region from the current image, which is also empty.
+        """
+        return self
+
+def choose_providers(source, zoom):
+    """ Return a list of data sources and proportions for a named source and zoom level.
+    
+        Source can be "srtm-ned", "ned-only", "vfp", "worldwide"
+        or a function path such as "Module.Submodule:Function".
+    """
+    if source == 'srtm-ned':
+        providers = choose_providers_srtm(zoom)
+    
+    elif source == 'ned-only':
+        providers = choose_providers_ned(zoom)
+
+    elif source == 'vfp':
+        providers = [(dem_module('VFP'), 1)]
+
+    elif source == 'worldwide':
+        providers = [(dem_module('Worldwide'), 1)]
+
+    else:
+        providers = load_func_path(source)(zoom)
+    
+    assert sum([proportion for (mod, proportion) in providers]) == 1.0
+    
+    return providers
+
 def choose_providers_srtm(zoom):
     """ Return a list of data sources and proportions for given zoom level.
         
         Each data source is a module such as SRTM1 or SRTM3, and the proportions
         must all add up to one. Return list has either one or two items.
     """
+    SRTM3, SRTM1, NED10m = map(dem_module, ('SRTM3', 'SRTM1', 'NED10m'))
+    
     if zoom <= SRTM3.ideal_zoom:
         return [(SRTM3, 1)]
 
@@ -247,6 +434,8 @@ def choose_providers_ned(zoom):
         Each data source is a module such as NED10m or NED1km, and the proportions
         must all add up to one. Return list has either one or two items.
     """
+    NED1km, NED100m, NED10m = map(dem_module, ('NED1km', 'NED100m', 'NED10m'))
+    
     if zoom <= NED1km.ideal_zoom:
         return [(NED1km, 1)]
 
@@ -269,9 +458,34 @@ def choose_providers_ned(zoom):
 
     return [(bottom, proportion), (top, 1 - proportion)]
 
+def warped_path(warpdir, module, quality, zoom, width, height, xmin, ymin, xmax, ymax):
+    """ Return a path in warpdir for one module's warped elevation of an area.
+    
+        The path depends on everything that affects warping, but not on
+        blend proportions, so they can be changed without warping again.
+    """
+    name = module.__name__.split('.')[-1]
+    key = '%s %s %d %d %.6f %.6f %.6f %.6f' % (name, quality, width, height, xmin, ymin, xmax, ymax)
+    hash = md5(key).hexdigest()
+    
+    return join(warpdir, name, str(zoom), hash[:3], hash[3:] + '.npy')
+
+def save_warped(path, elevation):
+    """ Atomically save an array of warped elevation to a path.
+    """
+    make_dir(dirname(path))
+    
+    handle, tmp_path = mkstemp(dir=dirname(path), prefix='tmp-', suffix='.npy')
+    close(handle)
+    
+    numpy.save(tmp_path, elevation)
+    rename(tmp_path, path)
+
 def make_empty_datasource(width, height, xform, wkt, tmpdir):
     '''
     '''
+    from osgeo import gdal
+
     driver = gdal.GetDriverByName('GTiff')
     handle, filename = mkstemp(dir=tmpdir, prefix='dem-tools-hillup-data-render-', suffix='.tif')
     close(handle)
@@ -280,22 +494,52 @@ def make_empty_datasource(width, height, xform, wkt, tmpdir):
     ds.SetGeoTransform(xform)
     ds.SetProjection(wkt)
     
-    ds.GetRasterBand(1).WriteArray(numpy.ones((width, height), numpy.float32) * -9999, 0, 0)
+    ds.GetRasterBand(1).Fill(-9999)
     ds.GetRasterBand(1).SetNoDataValue(-9999)
     
     return ds
 
-def calculate_slope_aspect(elevation, xres, yres, z=1.0):
+def blend_elevation(elevation, layer, proportion, nodata):
+    """ Alpha-blend a layer of elevations into a composite, in place.
+    
+        Both arrays should be the same shape, typically float32. Proportion
+        is the weight of the new layer. Where only one of the two arrays has
+        data that value is used unchanged, and where neither does the result
+        is nodata. The layer array is overwritten and can be reused after.
+    """
+    has_layer = (layer != nodata)
+    has_both = has_layer & (elevation != nodata)
+    
+    # only the layer has data: take its values as-is.
+    numpy.logical_xor(has_layer, has_both, has_layer)
+    numpy.copyto(elevation, layer, where=has_layer)
+    
+    # both have data: elevation += (layer - elevation) * proportion
+    numpy.subtract(layer, elevation, layer, where=has_both)
+    numpy.multiply(layer, proportion, layer, where=has_both)
+    numpy.add(elevation, layer, elevation, where=has_both)
+
+def calculate_slope_aspect(elevation, xres, yres, z=1.0, threads=1, band_rows=256):
     """ Return a pair of arrays 2 pixels smaller than the input elevation array.
     
         Slope is returned in radians, from 0 for sheer face to pi/2 for
         flat ground. Aspect is returned in radians, counterclockwise from -pi
         at north around to pi.
         
+        With more than one thread, elevation is processed in bands of
+        band_rows rows plus a one-row halo above and below, which bounds
+        the size of temporary arrays and spreads work over a thread pool.
+        
         Logic here is borrowed from hillshade.cpp:
           http://www.perrygeo.net/wordpress/?p=7
     """
-    width, height = elevation.shape[0] - 2, elevation.shape[1] - 2
+    height, width = elevation.shape[0] - 2, elevation.shape[1] - 2
+    
+    if threads > 1:
+        def band(top, bottom):
+            return calculate_slope_aspect(elevation[top:bottom + 2], xres, yres, z)
+        
+        return map_bands(band, height, threads, band_rows)
     
     window = [z * elevation[row:(row + height), col:(col + width)]
               for (row, col)
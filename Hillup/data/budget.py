@@ -0,0 +1,180 @@
+""" Disk usage and least-recently-used eviction for a DEM directory.
+
+Local files are found by listing the md5-prefixed directories that DEM
+modules store them in, then matching them to quads with each module's
+locate(). The coverage index isn't trusted for this, since a file can be
+stored without its quad being marked PRESENT, e.g. by an older version.
+Evicting a quad deletes its files but leaves the index alone: a PRESENT
+quad with no local files is simply downloaded again when next needed, and
+MISSING quads and old .404 files are never touched. Download directories
+left behind by crashed processes are removed by evict() too.
+
+>>> parse_size('20G')
+21474836480
+>>> parse_size('512m')
+536870912
+>>> parse_size('1000')
+1000
+"""
+from os import listdir, stat, unlink
+from os.path import basename, isdir, join
+from string import hexdigits
+from shutil import rmtree
+from time import time
+
+from . import dem_module
+from .files import stored_files, deflate_path, zip_path, download_lock, download_prefix
+
+# DEM modules with their own coverage index, e.g. not Worldwide.
+module_names = 'SRTM1', 'SRTM3', 'VFP', 'NED10m', 'NED100m', 'NED1km'
+
+# Seconds before a download directory is taken to be left behind by a crash.
+stale_download = 86400
+
+size_units = dict(k=1024, m=1024**2, g=1024**3, t=1024**4)
+
+def parse_size(size):
+    """ Convert a size like "20G" or "512M" to a number of bytes.
+    """
+    size = size.strip().lower().rstrip('b')
+
+    if size[-1:] in size_units:
+        return int(float(size[:-1]) * size_units[size[-1]])
+
+    return int(size)
+
+def stored_paths(source_dir):
+    """ Return a set of all file paths in the md5-prefixed directories of source_dir.
+    """
+    paths = set()
+
+    if not isdir(source_dir):
+        return paths
+
+    for name in listdir(source_dir):
+        dirpath = join(source_dir, name)
+
+        if len(name) != 3 or name.strip(hexdigits) or not isdir(dirpath):
+            continue
+
+        paths.update([join(dirpath, file) for file in listdir(dirpath)])
+
+    return paths
+
+# Local quad locations by source directory and DEM module, see quad_locations().
+locations = {}
+
+def quad_locations(source_dir, name):
+    """ Return a dictionary of every possible local file of a DEM module's quads.
+
+        Keys are paths in any storage form, and values are (dem_path, lat, lon).
+        Finding them calls the module's locate() for every quad in the world,
+        so they're worked out once and kept.
+    """
+    if (source_dir, name) not in locations:
+        module = dem_module(name)
+        found = dict()
+
+        # north to south, because NED modules locate by absolute lat and lon.
+        for lat in range(89, -91, -1):
+            for lon in range(-180, 180):
+                try:
+                    url, dem_path, dem_none = module.locate(lat, lon, source_dir)
+                except ValueError:
+                    continue
+
+                for path in (dem_path, deflate_path(dem_path), zip_path(dem_path)):
+                    found.setdefault(path, (dem_path, lat, lon))
+
+        locations[(source_dir, name)] = found
+
+    return locations[(source_dir, name)]
+
+def stored_quads(source_dir, name, paths=None):
+    """ Generate (lat, lon, dem_path, bytes, atime) for each local quad of a DEM module.
+
+        Atime is the latest access time of any of the quad's files, kept
+        to within files.touch_interval by files.touch(). Paths
+        is an optional set from stored_paths(), to save listing it again.
+    """
+    quads = quad_locations(source_dir, name)
+    found = set()
+
+    if paths is None:
+        paths = stored_paths(source_dir)
+
+    for path in sorted(paths):
+        if path not in quads:
+            continue
+
+        dem_path, lat, lon = quads[path]
+
+        if dem_path in found:
+            continue
+
+        found.add(dem_path)
+        stats = [stat(path) for path in stored_files(dem_path)]
+        size = sum([st.st_size for st in stats])
+        atime = max([st.st_atime for st in stats])
+
+        yield lat, lon, dem_path, size, atime
+
+def usage(source_dir):
+    """ Return a dictionary of (quad count, bytes) for each DEM module.
+    """
+    usages = dict()
+    paths = stored_paths(source_dir)
+
+    for name in module_names:
+        sizes = [size for (lat, lon, path, size, atime) in stored_quads(source_dir, name, paths)]
+        usages[name] = len(sizes), sum(sizes)
+
+    return usages
+
+def evict(source_dir, budget):
+    """ Delete least-recently-used quads until a DEM directory fits in a budget of bytes.
+
+        Return a list of (module name, lat, lon, bytes) for each evicted quad.
+    """
+    quads = []
+    paths = stored_paths(source_dir)
+    remove_stale_downloads(paths)
+
+    for name in module_names:
+        for (lat, lon, path, size, atime) in stored_quads(source_dir, name, paths):
+            quads.append((atime, name, lat, lon, path, size))
+
+    quads.sort()
+    total = sum([size for (atime, name, lat, lon, path, size) in quads])
+    evicted = []
+
+    for (atime, name, lat, lon, path, size) in quads:
+        if total <= budget:
+            break
+
+        # don't pull a quad out from under a download in progress.
+        with download_lock(path):
+            for file in stored_files(path):
+                unlink(file)
+
+        total -= size
+        evicted.append((name, lat, lon, size))
+
+    return evicted
+
+def remove_stale_downloads(paths):
+    """ Remove download directories older than stale_download, see files.download_dir().
+
+        Paths is a set from stored_paths().
+    """
+    now = time()
+
+    for path in paths:
+        if basename(path).startswith(download_prefix) and isdir(path):
+            if now - stat(path).st_mtime > stale_download:
+                rmtree(path, True)
+
+if __name__ == '__main__':
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,153 @@
+""" Per-source index of DEM coverage over a one-degree grid.
+
+Each DEM module keeps one small file in the DEM directory recording, for
+every 1-degree quad, whether it's known to exist, known to be missing, or
+not yet checked. This replaces a filesystem check for a .404 marker file
+per quad with an in-memory lookup.
+
+Quads are keyed by whichever integer corner the module uses for them.
+
+>>> index = Coverage(None)
+>>> index.state(37, -123) == UNKNOWN
+True
+
+>>> index.mark(37, -123, PRESENT)
+>>> index.state(37, -123) == PRESENT
+True
+
+>>> index.mark(-38, 77, MISSING)
+>>> index.state(-38, 77) == MISSING
+True
+
+>>> list(index.quads(PRESENT))
+[(37, -123)]
+"""
+from os import chmod, close, fstat, makedirs, rename, stat, write
+from os.path import dirname, exists, join
+from tempfile import mkstemp
+from math import floor
+
+from .files import make_dir, download_lock
+
+UNKNOWN, PRESENT, MISSING = 0, 1, 2
+
+# two bits for each quad, four quads per byte.
+grid_bytes = 360 * 180 / 4
+
+# Coverage objects by file path, shared within a process.
+indexes = {}
+
+def index(source_dir, name):
+    """ Return the Coverage object for a named DEM module in a source directory.
+
+        Doesn't touch the filesystem after the first call, see Coverage.refresh().
+    """
+    path = join(source_dir, '%s.coverage' % name)
+
+    if path not in indexes:
+        indexes[path] = Coverage(path)
+
+    return indexes[path]
+
+class Coverage:
+    """ Two-bit state for each quad in a 360x180 grid, optionally persisted to a file.
+
+        Updates are written to a temporary file and renamed into place,
+        so other processes sharing the file never see a partial write, and
+        made under an exclusive lock on a sidecar file, so that two processes
+        marking quads at once don't lose each other's marks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.bits = bytearray(grid_bytes)
+
+        self.refresh()
+
+    def refresh(self, force=False):
+        """ Reload the index file if it has changed since last read.
+
+            Modification times can be too coarse to show every change, so
+            force a reload when it matters, e.g. before writing.
+        """
+        if self.path is None or not exists(self.path):
+            return
+
+        mtime = stat(self.path).st_mtime
+
+        if force or mtime != self.mtime:
+            file = open(self.path, 'rb')
+            bits = bytearray(file.read())
+            self.mtime = fstat(file.fileno()).st_mtime
+            file.close()
+
+            if len(bits) == grid_bytes:
+                self.bits = bits
+
+    def state(self, lat, lon):
+        """ Return UNKNOWN, PRESENT or MISSING for a quad.
+        """
+        offset, shift = _position(lat, lon)
+        return (self.bits[offset] >> shift) & 0x03
+
+    def mark(self, lat, lon, state):
+        """ Set the state of a quad, and save it if there's a file.
+
+            With a file, the latest index is read, changed and written back
+            all under the lock, so marks from other processes are kept.
+        """
+        if self.path is None:
+            self._set(lat, lon, state)
+            return
+
+        make_dir(dirname(self.path))
+
+        with download_lock(self.path):
+            self.refresh(True)
+            self._set(lat, lon, state)
+            self.save()
+
+    def _set(self, lat, lon, state):
+        """ Set the state of a quad in memory.
+        """
+        offset, shift = _position(lat, lon)
+        self.bits[offset] = (self.bits[offset] & ~(0x03 << shift)) | (state << shift)
+
+    def save(self):
+        """ Atomically replace the index file with current state.
+
+            Call with the lock held, see mark().
+        """
+        if not exists(dirname(self.path)):
+            makedirs(dirname(self.path))
+        
+        handle, tmp_path = mkstemp(dir=dirname(self.path), prefix='coverage-', suffix='.tmp')
+        write(handle, str(self.bits))
+        close(handle)
+
+        chmod(tmp_path, 0666)
+        rename(tmp_path, self.path)
+
+        self.mtime = stat(self.path).st_mtime
+
+    def quads(self, state):
+        """ Generate (lat, lon) for each quad with a given state.
+        """
+        for offset in range(360 * 180):
+            if (self.bits[offset >> 2] >> ((offset & 3) * 2)) & 0x03 == state:
+                row, col = divmod(offset, 360)
+                yield row - 90, col - 180
+
+def _position(lat, lon):
+    """ Return byte offset and bit shift of a quad.
+    """
+    row = (int(floor(lat)) + 90) % 180
+    col = (int(floor(lon)) + 180) % 360
+    offset = row * 360 + col
+
+    return offset >> 2, (offset & 3) * 2
+
+if __name__ == '__main__':
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,88 @@
+""" Content-addressed tile storage for seeding output.
+
+Large parts of a seed are byte-for-byte identical: flat lakes, sea-level
+plains and especially empty tiles with no elevation data. DedupDisk stores
+each unique payload once and hardlinks tile paths to it, so readers such
+as Hillup.tiles see ordinary files in the usual places.
+"""
+from os import chmod, close, getpid, link, makedirs, rename, write
+from os.path import dirname, exists, join
+from errno import EEXIST, EMLINK
+from tempfile import mkstemp
+from hashlib import sha1
+
+from TileStache.Caches import Disk
+
+class DedupDisk (Disk):
+    """ TileStache Disk cache that stores each unique tile payload only once.
+
+        Payloads are kept in a "blobs" directory under the cache path,
+        named by SHA-1 hash of their contents. Counts of tiles and bytes
+        saved are kept to report a deduplication ratio.
+    """
+    def __init__(self, path, umask=0022, dirs='safe'):
+        Disk.__init__(self, path, umask, dirs, gzip=[])
+
+        self.blobdir = join(self.cachepath, 'blobs')
+
+        self.tiles, self.tile_bytes = 0, 0
+        self.blobs, self.blob_bytes = 0, 0
+
+    def save(self, body, layer, coord, format):
+        """ Save a tile as a hardlink to the blob of its contents.
+        """
+        digest = sha1(body).hexdigest()
+        blob_path = join(self.blobdir, digest[:2], digest[2:])
+        tile_path = self._fullpath(layer, coord, format)
+
+        if not exists(blob_path):
+            self._save_blob(body, blob_path)
+
+        self._makedirs(dirname(tile_path))
+        tmp_path = '%s.%d.tmp' % (tile_path, getpid())
+
+        try:
+            link(blob_path, tmp_path)
+
+        except OSError, e:
+            if e.errno != EMLINK:
+                raise
+
+            # Too many links to one inode: start a fresh copy of the
+            # blob, leaving earlier tiles linked to the old one.
+            self._save_blob(body, blob_path)
+            link(blob_path, tmp_path)
+
+        rename(tmp_path, tile_path)
+
+        self.tiles += 1
+        self.tile_bytes += len(body)
+
+    def ratio(self):
+        """ Return the ratio of tile bytes saved to unique blob bytes written.
+        """
+        return float(self.tile_bytes) / (self.blob_bytes or 1)
+
+    def _save_blob(self, body, blob_path):
+        """ Atomically write one new blob file.
+        """
+        self._makedirs(dirname(blob_path))
+
+        handle, tmp_path = mkstemp(dir=dirname(blob_path), suffix='.tmp')
+        write(handle, body)
+        close(handle)
+
+        chmod(tmp_path, 0666 & ~self.umask)
+        rename(tmp_path, blob_path)
+
+        self.blobs += 1
+        self.blob_bytes += len(body)
+
+    def _makedirs(self, path):
+        """ Make a directory and its parents if they don't already exist.
+        """
+        try:
+            makedirs(path, 0777 & ~self.umask)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
@@ -0,0 +1,251 @@
+""" Local file handling for DEM modules, safe to share between processes.
+
+Several seeding processes may use one DEM directory at the same time. Each
+quad is downloaded under an exclusive lock so only one process fetches it,
+and files are written under a temporary name and renamed into place so that
+readers never see one half-written.
+
+Downloaded DEMs can be stored in one of three forms, chosen by the storage
+setting below before anything is downloaded:
+
+  "raw" keeps uncompressed rasters, as they've always been kept.
+  "zip" keeps a zip archive opened through GDAL's /vsizip, which for SRTM
+        is the original archive exactly as downloaded.
+  "deflate" recompresses into a tiled, deflated GeoTIFF.
+
+Reading works the same for any mix of the three, see stored_dem().
+"""
+from os import chmod, listdir, makedirs, rename, stat, utime
+from os.path import basename, dirname, exists, isdir, join, splitext
+from tempfile import mkdtemp
+from shutil import rmtree
+from zipfile import ZipFile, ZIP_DEFLATED
+from fcntl import flock, LOCK_EX, LOCK_UN
+from contextlib import contextmanager
+from errno import EEXIST
+from time import time
+
+storage = 'raw'
+
+storage_forms = 'raw', 'zip', 'deflate'
+
+def make_dir(path):
+    """ Make a world-writeable directory, unless it already exists.
+    """
+    try:
+        makedirs(path)
+        chmod(path, 0777)
+
+    except OSError, e:
+        if e.errno != EEXIST or not isdir(path):
+            raise
+
+@contextmanager
+def download_lock(path):
+    """ Hold an exclusive lock for downloading a local file path.
+
+        Other processes block until the lock is released, and should then
+        check again whether the file exists before downloading it.
+    """
+    lock_file = open(path + '.lock', 'a')
+
+    try:
+        flock(lock_file, LOCK_EX)
+        yield
+
+    finally:
+        flock(lock_file, LOCK_UN)
+        lock_file.close()
+
+# Prefix of temporary directories for downloads, see download_dir().
+download_prefix = 'download-'
+
+@contextmanager
+def download_dir(dem_path):
+    """ Hold a new temporary directory for downloading a DEM, removed afterwards.
+    
+        It's made next to dem_path, on the same filesystem so that ingest()
+        can rename files into place. Any left behind by a crashed process
+        are removed by Hillup.data.budget.evict().
+    """
+    dirpath = mkdtemp(prefix=download_prefix, dir=dirname(dem_path))
+    
+    try:
+        yield dirpath
+    
+    finally:
+        rmtree(dirpath)
+
+def zip_path(dem_path):
+    """ Return the path of a zip-stored DEM.
+    """
+    return dem_path + '.zip'
+
+def deflate_path(dem_path):
+    """ Return the path of a DEM recompressed into a deflated GeoTIFF.
+    """
+    return splitext(dem_path)[0] + '.deflate.tif'
+
+def stored_file(dem_path):
+    """ Return the path of the local file holding a DEM in any storage form.
+    
+        Return None if it's not stored locally at all.
+    """
+    for path in (dem_path, deflate_path(dem_path), zip_path(dem_path)):
+        if exists(path):
+            return path
+    
+    return None
+
+def stored_dem(dem_path, path=None):
+    """ Return a GDAL-readable filename for a local DEM in any storage form.
+    
+        Return None if it's not stored locally at all. Optional path is
+        a result of stored_file(), to save looking for it again.
+    """
+    path = path or stored_file(dem_path)
+    
+    if path and path == zip_path(dem_path):
+        return '/vsizip/%s/%s' % (path, basename(dem_path))
+    
+    return path
+
+def stored_files(dem_path):
+    """ Return a list of local files holding a DEM in any storage form.
+    
+        The DEM itself comes first, followed by any sidecar files.
+    """
+    base = splitext(dem_path)[0]
+    paths = [dem_path, base + '.hdr', base + '.prj', deflate_path(dem_path), zip_path(dem_path)]
+    
+    return [path for path in paths if exists(path)]
+
+# Seconds between recorded accesses to one local DEM, see touch().
+touch_interval = 3600
+
+def touch(path):
+    """ Record an access to a local DEM file, for least-recently-used eviction.
+    
+        Path is a result of stored_file(). Access times are set explicitly
+        because filesystems mounted with noatime or relatime can't be
+        trusted to keep them, but no more than once every touch_interval.
+    """
+    now = time()
+    info = stat(path)
+    
+    if now - info.st_atime > touch_interval:
+        utime(path, (now, info.st_mtime))
+
+def local_dem(lat, lon, source_dir, index, locate, download):
+    """ Return a GDAL-readable filename for a DEM lat, lon corner, or None.
+    
+        If it doesn't already exist locally in source_dir, grab a new one.
+        Index is the DEM module's coverage index, and locate and download
+        are its functions: locate(lat, lon, source_dir) returns remote URL,
+        local DEM path and local 404 path, and download(url, dem_path)
+        returns true if it got a DEM and stored it at dem_path.
+    """
+    from .coverage import UNKNOWN, PRESENT, MISSING
+    
+    if index.state(lat, lon) == MISSING:
+        return None
+    
+    #
+    # Create a URL and a local filepath
+    #
+    try:
+        url, dem_path, dem_none = locate(lat, lon, source_dir)
+    except ValueError:
+        # we're probably outside a known region
+        index.mark(lat, lon, MISSING)
+        return None
+    
+    #
+    # Check if the file exists locally
+    #
+    path = stored_file(dem_path)
+    
+    if path:
+        if index.state(lat, lon) == UNKNOWN:
+            index.mark(lat, lon, PRESENT)
+        
+        touch(path)
+        return stored_dem(dem_path, path)
+
+    if exists(dem_none):
+        # left over from before there was a coverage index
+        index.mark(lat, lon, MISSING)
+        return None
+
+    make_dir(dirname(dem_path))
+    
+    with download_lock(dem_path):
+        #
+        # Check again in case another process just got it
+        #
+        index.refresh()
+        
+        if index.state(lat, lon) != MISSING and not stored_dem(dem_path):
+            if download(url, dem_path):
+                index.mark(lat, lon, PRESENT)
+            else:
+                index.mark(lat, lon, MISSING)
+
+    #
+    # The file better exist locally now
+    #
+    return stored_dem(dem_path)
+
+def ingest(dem_path, dirpath, archive=None):
+    """ Move a newly-downloaded DEM into place in the form chosen by storage.
+    
+        Dirpath is a temporary directory on the same filesystem as dem_path,
+        holding the raw DEM under basename(dem_path) along with any sidecar
+        files such as .hdr or .prj. Archive is an optional path to the
+        original download, kept as-is in "zip" storage if its contents match.
+    """
+    name = basename(dem_path)
+    sidecars = sorted([file for file in listdir(dirpath) if file != name
+                       and splitext(file)[0] == splitext(name)[0]])
+    
+    if storage == 'raw':
+        # the DEM itself is last to appear, so its presence means complete.
+        for file in sidecars + [name]:
+            chmod(join(dirpath, file), 0666)
+            rename(join(dirpath, file), join(dirname(dem_path), file))
+    
+    elif storage == 'zip':
+        if archive and sorted(ZipFile(archive).namelist()) == sorted(sidecars + [name]):
+            tmp_path = archive
+        
+        else:
+            tmp_path = join(dirpath, 'tmp.zip')
+            zipfile = ZipFile(tmp_path, 'w', ZIP_DEFLATED)
+            
+            for file in sidecars + [name]:
+                zipfile.write(join(dirpath, file), file)
+            
+            zipfile.close()
+        
+        chmod(tmp_path, 0666)
+        rename(tmp_path, zip_path(dem_path))
+    
+    elif storage == 'deflate':
+        from osgeo import gdal
+        
+        tmp_path = join(dirpath, 'tmp.tif')
+        source_ds = gdal.Open(join(dirpath, name), gdal.GA_ReadOnly)
+        
+        # floating point predictor for floats, horizontal differencing otherwise.
+        floats = source_ds.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+        options = ['COMPRESS=DEFLATE', 'PREDICTOR=%d' % (3 if floats else 2), 'TILED=YES']
+        
+        driver = gdal.GetDriverByName('GTiff')
+        tmp_ds = driver.CreateCopy(tmp_path, source_ds, 0, options)
+        tmp_ds = None # GDAL is lame about actually writing data until this object is out of scope
+        
+        chmod(tmp_path, 0666)
+        rename(tmp_path, deflate_path(dem_path))
+    
+    else:
+        raise ValueError('Unknown DEM storage "%s", not one of %s' % (storage, ', '.join(storage_forms)))
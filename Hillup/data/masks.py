@@ -0,0 +1,231 @@
+""" Geographic masks for pruning seeded tiles.
+
+A mask answers two questions about a bounding box in degrees: whether it
+might intersect the area of interest at all, and whether it lies entirely
+inside it. Tile generation uses the first to skip a tile along with all of
+its children, and the second to stop asking about a tile's children.
+
+Answers may err on the side of including too much, never too little.
+
+>>> square = PolygonMask({'type': 'Polygon', 'coordinates': [[(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]]})
+>>> square.intersects(5, 5, 15, 15), square.contains(5, 5, 15, 15)
+(True, False)
+>>> square.intersects(2, 2, 3, 3), square.contains(2, 2, 3, 3)
+(True, True)
+>>> square.intersects(11, 11, 12, 12)
+False
+>>> square.intersects(-1, -1, 11, 11), square.contains(-1, -1, 11, 11)
+(True, False)
+
+>>> donut = PolygonMask({'type': 'Polygon', 'coordinates': [[(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)], [(4, 4), (6, 4), (6, 6), (4, 6), (4, 4)]]})
+>>> donut.intersects(4.5, 4.5, 5.5, 5.5), donut.contains(1, 1, 2, 2)
+(False, True)
+"""
+from math import floor
+import json
+
+from . import webmerc_proj, dem_module
+from . import coverage
+from .coverage import MISSING
+
+#
+# DEM modules used by each Hillup.data.Provider source, for coverage masks.
+#
+source_modules = {
+    'srtm-ned': ('SRTM3', 'SRTM1', 'NED10m'),
+    'ned-only': ('NED1km', 'NED100m', 'NED10m'),
+    'vfp': ('VFP', ),
+    'worldwide': ('VFP', 'SRTM3')
+    }
+
+def coordinate_bbox(coord):
+    """ Return west, south, east, north in degrees for a tile coordinate.
+    """
+    northwest = webmerc_proj.coordinateLocation(coord)
+    southeast = webmerc_proj.coordinateLocation(coord.right().down())
+
+    return northwest.lon, southeast.lat, southeast.lon, northwest.lat
+
+class PolygonMask:
+    """ Mask of GeoJSON polygons or multipolygons, with holes.
+
+        Accepts a geometry, feature or feature collection as parsed JSON.
+    """
+    def __init__(self, geojson):
+        self.polygons = [[_ring_segments(ring) for ring in polygon]
+                         for polygon in _polygons(geojson)]
+
+    def intersects(self, west, south, east, north):
+        for polygon in self.polygons:
+            if _crosses(polygon, west, south, east, north):
+                return True
+
+            if _inside(polygon, (west + east) / 2., (south + north) / 2.):
+                return True
+
+        return False
+
+    def contains(self, west, south, east, north):
+        for polygon in self.polygons:
+            if _crosses(polygon, west, south, east, north):
+                return False
+
+            if _inside(polygon, (west + east) / 2., (south + north) / 2.):
+                return True
+
+        return False
+
+class CoverageMask:
+    """ Mask of 1-degree quads not known to be missing from DEM coverage indexes.
+
+        Quads that haven't been checked yet count as covered, so this only
+        prunes areas where earlier downloads have already come up empty.
+    """
+    def __init__(self, source_dir, names):
+        self.modules = [(dem_module(name), coverage.index(source_dir, name)) for name in names]
+
+    def _states(self, west, south, east, north):
+        """ Generate True or False for each quad overlapping an area, True if it's covered.
+        """
+        for lon in range(int(floor(west)), int(floor(east)) + 1):
+            for lat in range(int(floor(south)), int(floor(north)) + 1):
+                yield self._covered(lon, lat)
+
+    def _covered(self, lon, lat):
+        """ Return true if the quad with lower-left corner (lon, lat) might have data.
+        """
+        for (module, index) in self.modules:
+            # each module keys its quads by whichever corner it likes.
+            for (key_lon, key_lat) in module.quads(lon + .5, lat + .5, lon + .5, lat + .5):
+                if index.state(key_lat, key_lon) != MISSING:
+                    return True
+
+        return False
+
+    def intersects(self, west, south, east, north):
+        for covered in self._states(west, south, east, north):
+            if covered:
+                return True
+
+        return False
+
+    def contains(self, west, south, east, north):
+        for covered in self._states(west, south, east, north):
+            if not covered:
+                return False
+
+        return True
+
+class AllMasks:
+    """ Combination of several masks, an area must be in all of them.
+    """
+    def __init__(self, masks):
+        self.masks = masks
+
+    def intersects(self, west, south, east, north):
+        for mask in self.masks:
+            if not mask.intersects(west, south, east, north):
+                return False
+
+        return True
+
+    def contains(self, west, south, east, north):
+        for mask in self.masks:
+            if not mask.contains(west, south, east, north):
+                return False
+
+        return True
+
+def load_polygon(filename):
+    """ Return a PolygonMask for a GeoJSON file.
+    """
+    return PolygonMask(json.load(open(filename)))
+
+def _polygons(geojson):
+    """ Generate lists of rings for each polygon in a GeoJSON object.
+    """
+    type = geojson['type']
+
+    if type == 'FeatureCollection':
+        for feature in geojson['features']:
+            for polygon in _polygons(feature):
+                yield polygon
+
+    elif type == 'Feature':
+        if geojson['geometry']:
+            for polygon in _polygons(geojson['geometry']):
+                yield polygon
+
+    elif type == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            for polygon in _polygons(geometry):
+                yield polygon
+
+    elif type == 'Polygon':
+        yield geojson['coordinates']
+
+    elif type == 'MultiPolygon':
+        for polygon in geojson['coordinates']:
+            yield polygon
+
+def _ring_segments(ring):
+    """ Return bounding box and list of segments for a ring of coordinates.
+    """
+    points = [(float(x), float(y)) for (x, y) in [point[:2] for point in ring]]
+    segments = zip(points, points[1:] + points[:1])
+
+    xs, ys = [x for (x, y) in points], [y for (x, y) in points]
+
+    return (min(xs), min(ys), max(xs), max(ys)), segments
+
+def _crosses(polygon, west, south, east, north):
+    """ Return true if any ring of a polygon passes through a bounding box.
+    """
+    for ((xmin, ymin, xmax, ymax), segments) in polygon:
+        if xmax < west or east < xmin or ymax < south or north < ymin:
+            continue
+
+        for ((x1, y1), (x2, y2)) in segments:
+            if _segment_in_box(x1, y1, x2, y2, west, south, east, north):
+                return True
+
+    return False
+
+def _inside(polygon, x, y):
+    """ Return true if a point is inside a polygon, by even-odd rule over all its rings.
+    """
+    inside = False
+
+    for (bbox, segments) in polygon:
+        for ((x1, y1), (x2, y2)) in segments:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+
+    return inside
+
+def _segment_in_box(x1, y1, x2, y2, west, south, east, north):
+    """ Return true if any part of a line segment is in a box, by Liang-Barsky clipping.
+    """
+    t0, t1 = 0., 1.
+    dx, dy = x2 - x1, y2 - y1
+
+    for (p, q) in ((-dx, x1 - west), (dx, east - x1), (-dy, y1 - south), (dy, north - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+
+        elif p < 0:
+            t0 = max(t0, q / p)
+
+        else:
+            t1 = min(t1, q / p)
+
+        if t0 > t1:
+            return False
+
+    return True
+
+if __name__ == '__main__':
+
+    import doctest
+    doctest.testmod()
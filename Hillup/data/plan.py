@@ -0,0 +1,175 @@
+""" Dry-run estimates of what a seed will download, store and compute.
+
+A Plan is given every tile coordinate a seed would render, and works out
+which DEM modules and quads each one needs the same way Provider.renderArea()
+does. Nothing is downloaded or rendered; coverage indexes and local files
+are checked to tell quads already on hand from those to be downloaded.
+
+Sizes and times below are rough per-quad and per-tile averages, good for
+deciding how many disks and machines to provision, not for billing.
+"""
+from . import choose_providers, dem_module
+from . import coverage
+from .coverage import MISSING
+from .files import stored_dem
+from .masks import coordinate_bbox
+
+#
+# Megabytes to download, store uncompressed, and store zipped or deflated,
+# for one quad of each module. VFP archives cover many quads, and are
+# downloaded whole for each one.
+#
+quad_megabytes = {
+    'SRTM3': (1.2, 2.75, 1.2),
+    'SRTM1': (11., 24.7, 11.),
+    'VFP': (20., 2.75, 1.2),
+    'NED10m': (310., 446., 250.),
+    'NED100m': (3., 4.5, 3.),
+    'NED1km': (.03, .05, .03)
+    }
+
+# JPEG-compressed slope and aspect, two bytes per pixel before compression.
+tile_bytes_per_pixel = .6
+
+# seconds of CPU to warp, blend and shade one megapixel from one DEM module.
+seconds_per_megapixel = 1.5
+
+class Plan:
+    """ Per-zoom and per-module tallies for a stream of tile coordinates.
+    """
+    def __init__(self, source, demdir, size=256, storage='raw'):
+        self.source = source
+        self.demdir = demdir
+        self.size = size
+        self.storage = storage
+
+        self.zooms = dict()
+        self.quads = dict()
+
+    def add(self, coord):
+        """ Add one tile coordinate to the plan.
+        """
+        zoom = int(coord.zoom)
+
+        if zoom not in self.zooms:
+            self.zooms[zoom] = dict(tiles=0, empty=0, renders=0, providers=choose_providers(self.source, zoom))
+
+        tally = self.zooms[zoom]
+        tally['tiles'] += 1
+
+        # lat/lon bbox buffered by one pixel on all sides, like renderArea().
+        west, south, east, north = coordinate_bbox(coord)
+        xbuf, ybuf = (east - west) / self.size, (north - south) / self.size
+        west, south, east, north = west - xbuf, south - ybuf, east + xbuf, north + ybuf
+
+        modules_with_data = 0
+
+        for (module, proportion) in tally['providers']:
+            found = False
+
+            for (name, key) in _module_quads(module, self.demdir, west, south, east, north):
+                if self._quad(name, key) in ('local', 'download'):
+                    found = True
+
+            if found:
+                modules_with_data += 1
+
+        if modules_with_data:
+            tally['renders'] += modules_with_data
+        else:
+            tally['empty'] += 1
+
+    def _quad(self, name, key):
+        """ Return and remember the state of a quad: local, download, missing or outside.
+        """
+        if (name, key) not in self.quads:
+            lon, lat = key
+            module = dem_module(name)
+            index = coverage.index(self.demdir, name)
+
+            try:
+                url, dem_path, dem_none = module.locate(lat, lon, self.demdir)
+            except ValueError:
+                state = 'outside'
+            else:
+                if index.state(lat, lon) == MISSING:
+                    state = 'missing'
+                elif stored_dem(dem_path):
+                    state = 'local'
+                else:
+                    state = 'download'
+
+            self.quads[(name, key)] = state
+
+        return self.quads[(name, key)]
+
+    def report(self, out):
+        """ Write a human-readable report to a file-like object.
+        """
+        megapixels = self.size * self.size / 1000000.
+        tile_mb = self.size * self.size * tile_bytes_per_pixel / 1048576.
+
+        print >> out, '%5s %10s %10s %10s %10s  %s' % ('zoom', 'tiles', 'empty', 'tiles MB', 'CPU hours', 'sources')
+
+        total_tiles, total_mb, total_hours = 0, 0., 0.
+
+        for zoom in sorted(self.zooms):
+            tally = self.zooms[zoom]
+            sources = ' + '.join(['%s %.2f' % (_name(module), proportion) for (module, proportion) in tally['providers']])
+
+            tiles_mb = (tally['tiles'] - tally['empty']) * tile_mb
+            hours = tally['renders'] * megapixels * seconds_per_megapixel / 3600
+
+            print >> out, '%5d %10d %10d %10.1f %10.2f  %s' % (zoom, tally['tiles'], tally['empty'], tiles_mb, hours, sources)
+
+            total_tiles, total_mb, total_hours = total_tiles + tally['tiles'], total_mb + tiles_mb, total_hours + hours
+
+        print >> out, '%5s %10d %10s %10.1f %10.2f' % ('total', total_tiles, '', total_mb, total_hours)
+        print >> out, ''
+
+        print >> out, '%-10s %8s %8s %8s %8s %12s %12s' % ('module', 'local', 'download', 'missing', 'outside', 'download MB', 'disk MB')
+
+        names = sorted(set([name for (name, key) in self.quads]))
+        total_download, total_disk = 0., 0.
+
+        for name in names:
+            states = [self.quads[(n, key)] for (n, key) in self.quads if n == name]
+            counts = dict([(state, states.count(state)) for state in ('local', 'download', 'missing', 'outside')])
+
+            download_mb, raw_mb, compressed_mb = quad_megabytes.get(name, (0, 0, 0))
+            disk_mb = raw_mb if self.storage == 'raw' else compressed_mb
+
+            download = counts['download'] * download_mb
+            disk = (counts['local'] + counts['download']) * disk_mb
+
+            print >> out, '%-10s %8d %8d %8d %8d %12.1f %12.1f' \
+                % (name, counts['local'], counts['download'], counts['missing'], counts['outside'], download, disk)
+
+            total_download, total_disk = total_download + download, total_disk + disk
+
+        print >> out, '%-10s %8s %8s %8s %8s %12.1f %12.1f' % ('total', '', '', '', '', total_download, total_disk)
+
+def _name(module):
+    """ Return the short name of a DEM module, e.g. "SRTM3".
+    """
+    return module.__name__.split('.')[-1]
+
+def _module_quads(module, demdir, west, south, east, north):
+    """ Generate (module name, (lon, lat)) for quads a module would use for an area.
+
+        Worldwide tries VFP first and falls back on SRTM3 only where VFP
+        is known to be missing, so it's planned as whichever it would use.
+    """
+    name = _name(module)
+
+    for (lon, lat) in module.quads(west, south, east, north):
+        key = int(lon), int(lat)
+
+        if name == 'Worldwide':
+            if coverage.index(demdir, 'VFP').state(lat, lon) == MISSING:
+                yield 'SRTM3', key
+            else:
+                yield 'VFP', key
+
+        else:
+            yield name, key
@@ -1,21 +1,407 @@
 from math import pi, log
+from sys import exc_info
 from tempfile import mkstemp
-from os import close, write, remove
+from os import close, write, remove, getpid
+from time import time
 from urlparse import urljoin, urlparse
 from os.path import join, exists
-from urllib import urlopen
-
-from TileStache.Geography import SphericalMercator
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+from Queue import Queue, Full
+from StringIO import StringIO
 
 from PIL.Image import BILINEAR as resample
 import numpy
 
-from . import arr2img, read_slope_aspect, shade_hills
+from . import arr2img, read_slope_aspect_bytes, bytes2slope, bytes2aspect, shade_hills, map_bands, default_lights, NoData
+
+def _flat_exponent(lights=default_lights):
+    """ Return an exponent that brings shaded flat ground to exactly 50% gray.
+    """
+    flat = numpy.array([pi/2], dtype=float)
+    flat = shade_hills(flat, flat, lights=lights)[0]
+    return log(0.5) / log(flat)
+
+flat_exponent = _flat_exponent()
+
+# Flat gray images by size, see flat_tile().
+flat_tiles = {}
+
+def flat_tile(width, height):
+    """ Return a flat ground image of the given size, shaded 50% gray.
+    """
+    if (width, height) not in flat_tiles:
+        flat = numpy.ones((height, width)) * pi/2
+        flat_tiles[(width, height)] = shaded_image(shade_tile(flat, flat))
+    
+    return flat_tiles[(width, height)].copy()
+
+def shade_tile(slope, aspect, threads=1, lights=default_lights):
+    """ Return 0-1 grayscale hillshading for slope and aspect, flat ground at 50% gray.
+    
+        Lights are as in Style, which shades 8-bit slope and aspect instead.
+    """
+    shaded = shade_hills(slope, aspect, threads, lights=lights).clip(0, 1)
+
+    #
+    # Flat ground to 50% gray exactly by way of an exponent, after
+    # clipping because slopes facing away from the light shade below 0.
+    #
+    exponent = flat_exponent if lights == default_lights else _flat_exponent(lights)
+    
+    return numpy.power(shaded, exponent)
+
+def shaded_image(shaded):
+    """ Convert 0-1 grayscale hillshading to an 8-bit PIL image.
+    """
+    return arr2img(0xFF * shaded.clip(0, 1))
+
+class Style:
+    """ Hillshading with one set of lights, see Hillup.shade_hills().
+    
+        Every pair of stored 8-bit slope and aspect values is shaded up
+        front into a 256x256 table, with flat ground at 50% gray, so
+        shading a tile is one lookup per pixel straight from the bytes.
+        Several styles can be shaded from one read of a tile this way.
+    """
+    def __init__(self, lights=default_lights):
+        self.lights = lights
+        
+        values = numpy.arange(256, dtype=numpy.uint8)
+        slope, aspect = numpy.broadcast_arrays(bytes2slope(values).reshape(256, 1),
+                                               bytes2aspect(values).reshape(1, 256))
+        
+        # slope byte zero is flat ground.
+        flat = shade_hills(slope[:1, :1], aspect[:1, :1], lights=lights)[0, 0]
+        
+        if not 0 < flat < 1:
+            raise ValueError('Lights %s must shade flat ground between black and white, not %.3f' % (repr(lights), flat))
+        
+        shaded = shade_hills(slope, aspect, lights=lights).clip(0, 1)
+        self.table = numpy.power(shaded, log(0.5) / log(flat)).astype(numpy.float32)
+    
+    def shade(self, slope, aspect, threads=1, band_rows=256):
+        """ Return 0-1 grayscale hillshading for arrays of 8-bit slope and aspect.
+        
+            With more than one thread, rows are looked up in bands on a thread pool.
+        """
+        if threads > 1:
+            def band(top, bottom):
+                return self.table[slope[top:bottom], aspect[top:bottom]],
+            
+            return map_bands(band, slope.shape[0], threads, band_rows)[0]
+        
+        return self.table[slope, aspect]
+
+# Styles by lights, see get_style().
+styles = {}
+
+def get_style(lights=default_lights):
+    """ Return a Style for a list of lights, each an azimuth, altitude, weight and exponent.
+    
+        Styles are kept and shared, so each is only computed once.
+    """
+    lights = tuple([tuple(map(float, light)) for light in lights])
+    
+    for light in lights:
+        if len(light) != 4:
+            raise ValueError('Lights need an azimuth, altitude, weight and exponent, not %s' % repr(light))
+    
+    if lights not in styles:
+        styles[lights] = Style(lights)
+    
+    return styles[lights]
+
+#
+# ReaderCaches shared by name, see shared_cache().
+#
+shared_caches = {}
+shared_caches_lock = Lock()
+
+def shared_cache(name, max_bytes):
+    """ Return a ReaderCache shared by everyone who asks for the same name.
+    
+        It's as big as the biggest size any of them asked for.
+    """
+    with shared_caches_lock:
+        if name not in shared_caches:
+            shared_caches[name] = ReaderCache(max_bytes)
+        
+        cache = shared_caches[name]
+        cache.max_bytes = max(cache.max_bytes, max_bytes)
+        
+        return cache
+
+class ReaderCache:
+    """ Least-recently-used cache of 8-bit slope and aspect tiles, bounded by size.
+    
+        Tiles are kept as the byte planes stored in the GeoTIFF, a quarter
+        of the size of the decoded floating point arrays. Tiles with no
+        data are kept too, as a pair of Nones counted as nodata_bytes.
+        
+        Safe to share between threads, and concurrent reads of the same
+        tile are coalesced so it's only read once. A max_bytes of zero
+        keeps nothing but still coalesces reads. Cached tiles are kept
+        after forking, but not locks or reads underway in the parent.
+        
+        Tiles put in by a Prefetcher are tracked until they're first used
+        or evicted, with counts of each in prefetch_hits and prefetch_wasted.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.tiles = OrderedDict()
+        self.lock = Lock()
+        self.pid = getpid()
+        self.flights = SingleFlight()
+        
+        self.prefetched = dict()
+        self.prefetched_bytes = 0
+        self.prefetch_hits, self.prefetch_wasted = 0, 0
+    
+    def __contains__(self, key):
+        with self._lock():
+            return key in self.tiles
+    
+    def get(self, key):
+        """ Return slope and aspect bytes for a key, or None if they're not cached.
+        """
+        with self._lock():
+            if key not in self.tiles:
+                return None
+            
+            planes = self.tiles.pop(key)
+            self.tiles[key] = planes
+            self._used(key)
+            
+            return planes
+    
+    def used(self, key):
+        """ Count a prefetched tile as used, e.g. by a read that joined its prefetch.
+        """
+        with self._lock():
+            self._used(key)
+    
+    def put(self, key, planes, prefetched=False):
+        """ Cache a tuple of slope and aspect bytes, evicting older ones to fit.
+        """
+        size = _planes_size(planes)
+        
+        with self._lock():
+            if key in self.tiles:
+                return
+            
+            self.tiles[key] = planes
+            self.bytes += size
+            
+            if prefetched:
+                self.prefetched[key] = size
+                self.prefetched_bytes += size
+            
+            while self.bytes > self.max_bytes and self.tiles:
+                key, planes = self.tiles.popitem(last=False)
+                self.bytes -= _planes_size(planes)
+                
+                if key in self.prefetched:
+                    self.prefetched_bytes -= self.prefetched.pop(key)
+                    self.prefetch_wasted += 1
+    
+    def _used(self, key):
+        """ Count a prefetched tile as used, with the lock held.
+        """
+        if key in self.prefetched:
+            self.prefetched_bytes -= self.prefetched.pop(key)
+            self.prefetch_hits += 1
+    
+    def _lock(self):
+        """ Return the lock, or a new one in a newly-forked worker process.
+        
+            A thread in the parent might have held the old one at the time.
+        """
+        if self.pid != getpid():
+            self.pid, self.lock = getpid(), Lock()
+        
+        return self.lock
+
+# Rough size of a cached tile with no data, its key and tuple of Nones,
+# so that they're evicted like any other tile.
+nodata_bytes = 256
+
+def _planes_size(planes):
+    """ Return the size in bytes of a tuple of slope and aspect bytes.
+    """
+    if planes[0] is None:
+        return nodata_bytes
+    
+    return sum([plane.nbytes for plane in planes])
 
-def get_slope_aspect(source_dir, coord):
+class Prefetcher:
+    """ Background reads of tiles likely to be requested soon into a ReaderCache.
+    
+        After a tile is requested, its 8 neighbours and 4 children are
+        queued to be read by a fixed number of threads. The queue is short,
+        and tiles are dropped rather than queued when it's full or when
+        prefetched tiles not yet used add up to max_bytes, so prefetching
+        only uses spare capacity and never holds up requests.
+        
+        Tiles that couldn't be read, e.g. children of the deepest seeded
+        zoom, aren't tried again for miss_seconds. Up to max_misses of
+        them are remembered, and all are forgotten when there are more.
+    """
+    def __init__(self, cache, threads, max_bytes, queue_size=64, miss_seconds=60, max_misses=4096):
+        self.cache = cache
+        self.threads = threads
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self.miss_seconds = miss_seconds
+        self.max_misses = max_misses
+        self.lock = Lock()
+        self.pid = None
+        
+        # Times of failed reads by key, used without a lock like a cache.
+        self.misses = dict()
+        
+        self.queued, self.dropped = 0, 0
+    
+    def after(self, source_dir, coord):
+        """ Queue up the neighbours and children of a just-requested tile.
+        """
+        with self.lock:
+            if self.pid != getpid():
+                # See BackgroundRenders.start() about forked processes.
+                self.pid, self.queue = getpid(), Queue(self.queue_size)
+                
+                for i in range(self.threads):
+                    thread = Thread(target=self._work, args=(self.queue, ))
+                    thread.daemon = True
+                    thread.start()
+        
+        for other in likely_next(coord):
+            key = cache_key(source_dir, other)
+            
+            if key in self.cache:
+                continue
+            
+            if time() - self.misses.get(key, 0) < self.miss_seconds:
+                continue
+            
+            try:
+                if self.cache.prefetched_bytes >= self.max_bytes:
+                    raise Full()
+                
+                self.queue.put_nowait((source_dir, other))
+                self.queued += 1
+            
+            except Full:
+                self.dropped += 1
+    
+    def drain(self):
+        """ Wait for queued tiles to be read, e.g. before forking.
+        """
+        if self.pid == getpid():
+            self.queue.join()
+    
+    def stats(self):
+        """ Return a dictionary of prefetch counts.
+        """
+        return dict(queued=self.queued, dropped=self.dropped,
+                    hits=self.cache.prefetch_hits, wasted=self.cache.prefetch_wasted,
+                    pending_bytes=self.cache.prefetched_bytes)
+    
+    def _work(self, queue):
+        while True:
+            source_dir, coord = queue.get()
+            key = cache_key(source_dir, coord)
+            
+            try:
+                if key not in self.cache:
+                    self.cache.flights.do(key, read_cached_bytes, source_dir, coord, self.cache, True)
+            except Exception:
+                # Missing or broken tiles are for a real request to report.
+                if len(self.misses) >= self.max_misses:
+                    self.misses = dict()
+                
+                self.misses[key] = time()
+            finally:
+                queue.task_done()
+
+def likely_next(coord):
+    """ Generate the 8 neighbours and 4 children of a tile, as requested while panning or zooming.
+    """
+    size = 2**coord.zoom
+    seen = set([(coord.column, coord.row)])
+    
+    for (down, right) in ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)):
+        other = coord.down(down).right(right)
+        
+        # wrap around the antimeridian, which repeats tiles at low zooms.
+        other.column %= size
+        
+        if 0 <= other.row < size and (other.column, other.row) not in seen:
+            seen.add((other.column, other.row))
+            yield other
+    
+    child = coord.zoomBy(1)
+    
+    for (down, right) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+        yield child.down(down).right(right)
+
+def get_slope_aspect(source_dir, coord, cache=None):
     """ Retrieve slope and aspect for a coordinate tile in a source directory.
     
         Source directory can be a local path, absolute path or URL.
+        
+        Optional cache is a ReaderCache to check before reading the tile.
+    """
+    slope, aspect = get_slope_aspect_bytes(source_dir, coord, cache)
+    
+    return bytes2slope(slope), bytes2aspect(aspect)
+
+def get_slope_aspect_bytes(source_dir, coord, cache=None):
+    """ Retrieve 8-bit slope and aspect for a coordinate tile in a source directory.
+    
+        Optional cache is a ReaderCache to check before reading the tile.
+    """
+    if cache is None:
+        return read_tile_bytes(source_dir, coord)
+    
+    key = cache_key(source_dir, coord)
+    planes = cache.get(key)
+    
+    if planes is None:
+        planes = cache.flights.do(key, read_cached_bytes, source_dir, coord, cache)
+        
+        # this may have joined a prefetch of the same tile.
+        cache.used(key)
+    
+    if planes[0] is None:
+        raise NoData('No elevation data in tile %d/%d/%d' % (coord.zoom, coord.column, coord.row))
+    
+    return planes
+
+def read_cached_bytes(source_dir, coord, cache, prefetched=False):
+    """ Read 8-bit slope and aspect for a tile into a ReaderCache and return them.
+    
+        Tiles with no data are returned and cached as a pair of Nones.
+    """
+    try:
+        planes = read_tile_bytes(source_dir, coord)
+    except NoData:
+        planes = None, None
+    
+    cache.put(cache_key(source_dir, coord), planes, prefetched)
+    
+    return planes
+
+def cache_key(source_dir, coord):
+    """ Return a ReaderCache key for a coordinate tile in a source directory.
+    """
+    return source_dir, int(coord.zoom), int(coord.column), int(coord.row)
+
+def read_tile_bytes(source_dir, coord):
+    """ Read 8-bit slope and aspect for a coordinate tile in a source directory.
+    
+        Source directory can be a local path, absolute path or URL.
     """
     #
     # Find a file to work with
@@ -27,11 +413,13 @@ def get_slope_aspect(source_dir, coord):
     
     if scheme in ('file', ''):
         # Local files are read directly
-        return read_slope_aspect(join(dir_path, tile_path))
+        return read_slope_aspect_bytes(join(dir_path, tile_path))
     
     if scheme != 'http':
         raise IOError('Unknown scheme "%s"' % scheme)
 
+    from urllib import urlopen
+
     try:
         # Remote tiles have to be downloaded first for GDAL.
         tile_href = urljoin(source_dir.rstrip('/')+'/', tile_path)
@@ -40,13 +428,74 @@ def get_slope_aspect(source_dir, coord):
         write(handle, urlopen(tile_href).read())
         close(handle)
         
-        return read_slope_aspect(join(dir_path, tile_path))
+        return read_slope_aspect_bytes(join(dir_path, tile_path))
     
     finally:
         # No matter what happens, keep the local filesystem clean.
         remove(tile_path)
 
-def render_tile(source_dir, coord, min_zoom):
+def resized_image(shaded, size):
+    """ Convert 0-1 grayscale hillshading to an 8-bit PIL image of a given size.
+    
+        Pixels are resampled at most once: whole-number reductions are
+        averaged before quantizing to 8 bits, and anything else is left
+        to PIL.
+    """
+    h, w = shaded.shape
+    width, height = size
+    
+    if (w, h) == (width, height):
+        return shaded_image(shaded)
+    
+    if w % width == 0 and h % height == 0 and w / width == h / height:
+        n = w / width
+        return shaded_image(shaded.reshape(height, n, width, n).mean(axis=3).mean(axis=1))
+    
+    return shaded_image(shaded).resize((width, height), resample)
+
+def assemble_descendants(source_dir, coord, depth, threads=1, cache=None, style=None):
+    """ Return 0-1 grayscale hillshading for a tile made from its descendants.
+    
+        Each of the 4 (depth 1) or 16 (depth 2) descendant tiles is shaded
+        at its own resolution, and returned in a mosaic 2 or 4 times the
+        size of one for resized_image() to reduce. Shading before
+        downsampling keeps ridges crisp and avoids averaging aspect angles
+        across the wraparound at north.
+        
+        Raise IOError if any descendant is missing, NoData if all are empty.
+        
+        Optional cache is a ReaderCache, see get_slope_aspect(), and
+        optional style is a Style to shade with, see render_tile().
+    """
+    style = style or get_style()
+    count = 2**depth
+    corner = coord.zoomBy(depth)
+    tiles = []
+    
+    # Read everything before shading anything, in case one is missing.
+    for row in range(count):
+        for column in range(count):
+            try:
+                slope, aspect = get_slope_aspect_bytes(source_dir, corner.down(row).right(column), cache)
+            except NoData:
+                continue
+            else:
+                tiles.append((row, column, slope, aspect))
+    
+    if not tiles:
+        raise NoData('No elevation data under tile %d/%d/%d' % (coord.zoom, coord.column, coord.row))
+    
+    h, w = tiles[0][2].shape
+    
+    # Flat ground is 50% gray, see flat_exponent.
+    mosaic = numpy.ones((count * h, count * w), dtype=numpy.float32) * .5
+    
+    for (row, column, slope, aspect) in tiles:
+        mosaic[row*h:(row+1)*h, column*w:(column+1)*w] = style.shade(slope, aspect, threads)
+    
+    return mosaic
+
+def render_tile(source_dir, coord, min_zoom, threads=1, nodata_size=(256, 256), max_descend=0, cache=None, size=None, style=None):
     """ Render a single tile.
 
         Looks for two-band slope+aspect TIFF files in the provided source
@@ -57,50 +506,279 @@ def render_tile(source_dir, coord, min_zoom):
         is not immediately available, but stop checking at min_zoom.
         
         Source directory can be a local path, absolute path or URL.
+        
+        Threads is the number of threads used for shading large tiles.
+        
+        Tiles stored with no elevation data at all are returned as flat
+        ground images of nodata_size without being decoded or shaded.
+        
+        If the requested zoom is not available, look for a complete set of
+        its descendants up to max_descend zoom levels deeper and assemble
+        the tile from those, before checking lower zoom levels. This way
+        one deep zoom can be seeded and used for shallower ones, e.g. zoom
+        14 with max_descend=2 also covers zooms 12 and 13.
+        
+        Optional cache is a ReaderCache, see get_slope_aspect().
+        
+        Optional size is the width and height of the returned image,
+        otherwise the size of the stored tile. Only the needed pixels are
+        decoded and shaded, and resampled just once to get to size. If
+        size is 2 or 4 times the stored tiles, e.g. 512 pixel high-DPI
+        tiles from 256 pixel ones, the next zoom levels down are used
+        where they're available, instead of upsampling. Once the stored
+        size is known, see stored_sizes, they're tried first of all.
+        
+        Optional style is a Style with the lights to shade with, otherwise
+        the default lights of Hillup.shade_hills().
     """
     original = coord.copy()
+    nodata_size = size or nodata_size
+    style = style or get_style()
     
     if original.zoom < min_zoom:
         raise Exception('Unable to find a suitable DEM tile for tile %d/%d/%d at zoom %d or above.' % (original.zoom, original.column, original.row, min_zoom))
     
+    #
+    # Larger tiles than stored, use the next zoom levels down if they match.
+    # With the stored size known from earlier reads, try them before
+    # reading this zoom at all.
+    #
+    larger_tried = size and source_dir in stored_sizes
+    
+    if larger_tried:
+        image = larger_tile(source_dir, coord, stored_sizes[source_dir], size, threads, cache, style)
+        
+        if image is not None:
+            return image
+    
     while coord.zoom >= min_zoom:
         #
         # Basic hill shading
         #
         try:
-            slope, aspect = get_slope_aspect(source_dir, coord)
+            slope, aspect = get_slope_aspect_bytes(source_dir, coord, cache)
+        except NoData:
+            # Nothing but flat ground here, e.g. open ocean.
+            return flat_tile(*nodata_size)
         except IOError:
+            if coord.zoom == original.zoom:
+                # Try to assemble it from deeper zoom levels first.
+                for depth in range(1, max_descend + 1):
+                    try:
+                        shaded = assemble_descendants(source_dir, coord, depth, threads, cache, style)
+                    except NoData:
+                        return flat_tile(*nodata_size)
+                    except IOError:
+                        continue
+                    else:
+                        return resized_image(shaded, size or (shaded.shape[1] / 2**depth, shaded.shape[0] / 2**depth))
+            
             # File not found, zoom out and try again.
             coord = coord.zoomBy(-1).container()
             continue
-        else:
-            shaded = shade_hills(slope, aspect)
-
+        
+        h, w = slope.shape
+        stored_sizes[source_dir] = w, h
+        
+        if coord.zoom == original.zoom and size and not larger_tried:
+            image = larger_tile(source_dir, coord, (w, h), size, threads, cache, style)
+            
+            if image is not None:
+                return image
+        
         #
-        # Flat ground to 50% gray exactly by way of an exponent.
+        # Extract the desired tile out of the stored one, if necessary.
         #
-        flat = numpy.array([pi/2], dtype=float)
-        flat = shade_hills(flat, flat)[0]
-        exp = log(0.5) / log(flat)
+        if coord.zoom < original.zoom:
+            left, top, right, bottom = ancestor_window(original, coord, w, h)
+            slope, aspect = slope[top:bottom, left:right], aspect[top:bottom, left:right]
         
-        shaded = numpy.power(shaded, exp)
+        return resized_image(style.shade(slope, aspect, threads), size or (w, h))
+    
+    raise Exception('Unable to find a suitable DEM tile for tile %d/%d/%d at zoom %d or above.' % (original.zoom, original.column, original.row, min_zoom))
 
-        #
-        # Extract the desired tile out of the shaded image, if necessary.
-        #
-        h, w = shaded.shape
+# Width and height of stored tiles by source directory, see render_tile().
+stored_sizes = {}
+
+def larger_tile(source_dir, coord, stored_size, size, threads=1, cache=None, style=None):
+    """ Return an image of a tile 2 or 4 times the stored size from its descendants.
+    
+        Return None if size isn't one of those, or the descendants can't
+        all be found. Arguments are as in render_tile().
+    """
+    w, h = stored_size
+    
+    for depth in (1, 2):
+        if (w * 2**depth, h * 2**depth) == tuple(size):
+            try:
+                return resized_image(assemble_descendants(source_dir, coord, depth, threads, cache, style), size)
+            except (IOError, NoData):
+                pass
+    
+    return None
+
+def ancestor_window(coord, ancestor, width, height):
+    """ Return left, top, right, bottom pixels of a coordinate within an ancestor tile.
+    """
+    ul = coord.zoomTo(ancestor.zoom).left(ancestor.column).up(ancestor.row)
+    lr = coord.down().right().zoomTo(ancestor.zoom).left(ancestor.column).up(ancestor.row)
+    
+    return map(int, (ul.column * width, ul.row * height, lr.column * width, lr.row * height))
+
+def cached_ancestor(source_dir, coord, cache, size, threads=1, style=None):
+    """ Return an image cropped from the closest ancestor tile in a cache, or None.
+    
+        Nothing is read, so this is quick enough to serve while waiting
+        on a slow render_tile(). Size is the width and height to return.
+    """
+    style = style or get_style()
+    ancestor = coord.zoomBy(-1).container()
+    
+    while ancestor.zoom >= 0:
+        planes = cache.get(cache_key(source_dir, ancestor))
         
-        if coord.zoom < original.zoom:
-            ul = original.zoomTo(coord.zoom).left(coord.column).up(coord.row)
-            lr = original.down().right().zoomTo(coord.zoom).left(coord.column).up(coord.row)
+        if planes is None:
+            ancestor = ancestor.zoomBy(-1).container()
+            continue
+        
+        slope, aspect = planes
+        
+        if slope is None:
+            return flat_tile(*size)
+        
+        h, w = slope.shape
+        left, top, right, bottom = ancestor_window(coord, ancestor, w, h)
+        
+        if right <= left or bottom <= top:
+            # Too far up to have even one pixel.
+            return None
+        
+        slope, aspect = slope[top:bottom, left:right], aspect[top:bottom, left:right]
+        
+        return resized_image(style.shade(slope, aspect, threads), size)
+    
+    return None
+
+class Job:
+    """ One call to a function, and its result for everyone waiting on it.
+    """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = Event()
+        self.result, self.error = None, None
+    
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except:
+            self.error = exc_info()
+        finally:
+            self.done.set()
+    
+    def get(self):
+        """ Return the result, or raise whatever the function raised.
+        """
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        
+        return self.result
+
+class SingleFlight:
+    """ Coalesces concurrent calls with the same key into just one.
+    
+        The first caller for a key runs the function, and any others that
+        arrive before it finishes wait and share its result or exception.
+    """
+    def __init__(self):
+        self.jobs = dict()
+        self.lock = Lock()
+        self.pid = getpid()
+    
+    def do(self, key, func, *args):
+        """ Return func(*args), or the result of a call already underway for key.
+        """
+        if self.pid != getpid():
+            # In a newly-forked worker process, calls underway in the
+            # parent will never finish here, and one may hold the lock.
+            self.pid, self.jobs, self.lock = getpid(), dict(), Lock()
+        
+        with self.lock:
+            job = self.jobs.get(key)
+            first = job is None
+            
+            if first:
+                job = self.jobs[key] = Job(func, args)
+        
+        if first:
+            try:
+                job.run()
+            finally:
+                with self.lock:
+                    del self.jobs[key]
+        else:
+            job.done.wait()
+        
+        return job.get()
+
+class BackgroundRenders:
+    """ Fixed number of threads for renders that callers might not wait for.
+    
+        Each job has a key, and asking for a key that's already underway or
+        finished but not yet collected returns the same job. Up to keep
+        uncollected jobs are held on to for a later request to pick up.
+    """
+    def __init__(self, threads, keep=256):
+        self.threads = threads
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.pid = None
+    
+    def start(self, key, func, *args):
+        """ Return a Job for key, queuing func(*args) if needed.
+        """
+        with self.lock:
+            if self.pid != getpid():
+                # First use, or first use in a newly-forked worker process
+                # where threads started by the parent no longer exist.
+                self.pid, self.queue, self.jobs = getpid(), Queue(), OrderedDict()
+                
+                for i in range(self.threads):
+                    thread = Thread(target=self._work, args=(self.queue, ))
+                    thread.daemon = True
+                    thread.start()
             
-            left, top, right, bottom = map(int, (ul.column * w, ul.row * h, lr.column * w, lr.row * h))
+            if key not in self.jobs:
+                self.jobs[key] = Job(func, args)
+                self.queue.put(self.jobs[key])
+                
+                finished = [k for (k, job) in self.jobs.items() if job.done.is_set()]
+                
+                for k in finished[:max(0, len(self.jobs) - self.keep)]:
+                    del self.jobs[k]
             
-            shaded = shaded[top:bottom, left:right]
+            return self.jobs[key]
+    
+    def drain(self):
+        """ Wait for every job to finish, e.g. before forking.
+        """
+        with self.lock:
+            jobs = self.jobs.values() if self.pid == getpid() else []
         
-        return arr2img(0xFF * shaded.clip(0, 1)).resize((w, h), resample)
+        for job in jobs:
+            job.done.wait()
     
-    raise Exception('Unable to find a suitable DEM tile for tile %d/%d/%d at zoom %d or above.' % (original.zoom, original.column, original.row, min_zoom))
+    def collect(self, key):
+        """ Forget a job once its result has been used.
+        """
+        with self.lock:
+            if key in self.jobs and self.jobs[key].done.is_set():
+                del self.jobs[key]
+    
+    def _work(self, queue):
+        while True:
+            queue.get().run()
 
 class Provider:
     """ TileStache provider for rendering hillshaded tiles.
@@ -112,25 +790,140 @@ class Provider:
 
         Source directory can be a local path, absolute path or URL, and
         will be interpreted relative to the layer's configuration path.
+        
+        Optional threads parameter is the number of threads used for
+        shading, useful for very large tile sizes.
+        
+        Optional max_descend parameter is the number of zoom levels below
+        a missing tile to look for tiles to assemble it from, see render_tile().
+        
+        Optional cache_megabytes parameter is the size of a ReaderCache of
+        slope and aspect tiles kept in memory, zero by default.
+        
+        Concurrent requests for the same tile are rendered just once, and
+        concurrent reads of the same slope and aspect tile, e.g. for its
+        overzoomed descendants, are done just once too.
+        
+        Optional latency_budget parameter is a number of seconds to wait
+        for a tile. Renders happen on background_threads threads, and if
+        one takes longer than this a crop from the closest ancestor tile in
+        the cache is served instead, so it needs a cache_megabytes cache.
+        The crop is a PNG with a 200 status and a no-store Cache-Control
+        header, and isn't written to the TileStache cache, so the exact
+        tile is served from the next request on once it's finished.
+        
+        Optional prefetch_threads parameter is a number of threads to read
+        neighbours and children of each requested tile into the cache, see
+        Prefetcher, with up to prefetch_megabytes of them waiting to be
+        used. Needs a cache_megabytes big enough to hold them. Counts of
+        prefetched tiles used and wasted are returned by prefetch_stats().
+        
+        Optional lights parameter is a list of light sources to shade with,
+        each an azimuth and altitude in degrees, weight and exponent, see
+        Hillup.shade_hills() for the default.
+        
+        Optional cache_name parameter is a name for the ReaderCache, so
+        layers with different lights and the same source directory can
+        share one read of each tile, see shared_cache().
+        
+        Optional arena_path parameter is a path for a cache_megabytes cache
+        shared by all processes on the host, see Hillup.arena.ArenaCache,
+        with arena_tile_size the largest size of tile it will hold. Only
+        providers giving the same path and both sizes share one file.
     """
-    def __init__(self, layer, source_dir):
+    def __init__(self, layer, source_dir, threads=1, max_descend=0, cache_megabytes=0, latency_budget=None, background_threads=2, prefetch_threads=0, prefetch_megabytes=32, lights=default_lights, cache_name=None, arena_path=None, arena_tile_size=256):
         self.layer = layer
+        self.threads = threads
+        self.max_descend = max_descend
+        self.latency_budget = latency_budget
+        self.style = get_style(lights)
+        
+        if latency_budget is not None and not cache_megabytes:
+            raise ValueError('A latency_budget needs cache_megabytes for a cache to serve ancestor tiles from')
+        
+        if prefetch_threads and not cache_megabytes:
+            raise ValueError('A prefetch_threads setting needs cache_megabytes for a cache to prefetch tiles into')
+        
+        if arena_path is not None:
+            from .arena import ArenaCache
+            self.cache = ArenaCache(arena_path, cache_megabytes * 1024 * 1024, arena_tile_size)
+        elif cache_name is None:
+            self.cache = ReaderCache(cache_megabytes * 1024 * 1024)
+        else:
+            self.cache = shared_cache(cache_name, cache_megabytes * 1024 * 1024)
+        self.renders = BackgroundRenders(background_threads)
+        self.flights = SingleFlight()
+        
+        if prefetch_threads:
+            self.prefetcher = Prefetcher(self.cache, prefetch_threads, prefetch_megabytes * 1024 * 1024)
+        else:
+            self.prefetcher = None
         
         source_dir = urljoin(layer.config.dirpath, source_dir)
         scheme, host, path, p, q, f = urlparse(source_dir)
         assert scheme in ('http', 'file', '')
 
         self.source_dir = path if (scheme == '') else '%(scheme)s://%(host)s%(path)s' % locals()
+        
+        from TileStache.Geography import SphericalMercator
+        self.srs = SphericalMercator().srs
     
     def renderTile(self, width, height, srs, coord):
         """
         """
-        if srs != SphericalMercator().srs:
+        if srs != self.srs:
             raise Exception('Tile projection must be spherical mercator, not "%(srs)s"' % locals())
         
-        rendered = render_tile(self.source_dir, coord, 0)
-
-        if rendered.size != (width, height):
-            rendered = rendered.resize((width, height), resample)
-
-        return rendered
+        if self.prefetcher is not None:
+            self.prefetcher.after(self.source_dir, coord)
+        
+        key = coord.zoom, coord.column, coord.row, width, height
+        
+        if self.latency_budget is None:
+            return self.flights.do(key, self._render, coord, width, height)
+        
+        # Background renders are coalesced by key already.
+        job = self.renders.start(key, self._render, coord, width, height)
+        
+        if not job.done.wait(self.latency_budget):
+            fallback = cached_ancestor(self.source_dir, coord, self.cache, (width, height), self.threads, self.style)
+            
+            if fallback is not None:
+                from TileStache.Core import TheTileLeftANote
+                from wsgiref.headers import Headers
+                
+                # Not NoTileLeftBehind, which responds with a 404 status.
+                buff = StringIO()
+                fallback.save(buff, 'PNG')
+                headers = Headers([('Content-Type', 'image/png'), ('Cache-Control', 'no-store')])
+                raise TheTileLeftANote(headers, 200, buff.getvalue(), False)
+            
+            # Nothing better to show, so wait for it.
+            job.done.wait()
+        
+        self.renders.collect(key)
+        
+        return job.get()
+    
+    def drain(self):
+        """ Wait for background renders and prefetches to finish.
+        
+            Call before forking, so no reads or locks are left underway.
+        """
+        self.renders.drain()
+        
+        if self.prefetcher is not None:
+            self.prefetcher.drain()
+    
+    def prefetch_stats(self):
+        """ Return a dictionary of prefetch counts, see Prefetcher.stats().
+        """
+        if self.prefetcher is None:
+            return None
+        
+        return self.prefetcher.stats()
+    
+    def _render(self, coord, width, height):
+        """ Render a tile of the given size with render_tile().
+        """
+        return render_tile(self.source_dir, coord, 0, self.threads, (width, height), self.max_descend, self.cache, (width, height), self.style)
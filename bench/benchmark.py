@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+""" Offline benchmark for Hillup seeding and rendering.
+
+Synthetic DEM quads are generated in a scratch DEM directory so that nothing
+is downloaded, then each benchmark case is run in a fresh child process so
+that its peak resident memory can be measured on its own. Results are added
+to a JSON file and compared with the previous run.
+"""
+from sys import executable, exit, path, stderr
+from os.path import abspath, dirname, exists, join
+from os import makedirs, close, unlink
+from subprocess import Popen, PIPE
+from optparse import OptionParser
+from tempfile import mkdtemp, mkstemp
+from StringIO import StringIO
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from time import time, strftime
+import json
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+parser = OptionParser(usage="""%prog [options]
+
+Run every benchmark case and report tiles/sec and peak RSS.
+
+See `%prog --help` for info.""")
+
+defaults = dict(zooms='8,10,12,14', sources='srtm-ned,ned-only,worldwide',
+                size=256, count=4, results=join(dirname(abspath(__file__)), 'results.json'),
+                workdir=None, label='', lat=37.80, lon=-122.30, dem_storage='raw')
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-z', '--zooms', dest='zooms',
+                  help='Comma-separated zoom levels for renderArea cases, default "%(zooms)s".' % defaults)
+
+parser.add_option('-s', '--sources', dest='sources',
+                  help='Comma-separated Hillup.data.Provider sources, default "%(sources)s".' % defaults)
+
+parser.add_option('--tile-size', dest='size', type='int',
+                  help='Size of benchmarked tiles, default %(size)s.' % defaults)
+
+parser.add_option('-n', '--count', dest='count', type='int',
+                  help='Number of tiles per case, default %(count)s.' % defaults)
+
+parser.add_option('-r', '--results', dest='results',
+                  help='JSON file for storing results between runs, default "%(results)s".' % defaults)
+
+parser.add_option('-w', '--work-directory', dest='workdir',
+                  help='Directory for synthetic DEMs and tiles, kept between runs. Default is a temporary directory.')
+
+parser.add_option('-l', '--label', dest='label',
+                  help='Optional label for this run, e.g. a git revision.')
+
+parser.add_option('--dem-storage', dest='dem_storage', type='choice', choices=('raw', 'zip', 'deflate'),
+                  help='Storage form for synthetic DEM quads, one of "raw", "zip" or "deflate", default "%(dem_storage)s".' % defaults)
+
+parser.add_option('--case', dest='case',
+                  help='Run a single named case and print its result as JSON. Used internally.')
+
+#
+# Modules used by each source, to know which synthetic quads are needed.
+#
+
+source_modules = {
+    'srtm-ned': ('SRTM3', 'NED10m'),
+    'ned-only': ('NED1km', 'NED100m', 'NED10m'),
+    'vfp': ('VFP', ),
+    'worldwide': ('VFP', )
+    }
+
+def tile_coordinates(lat, lon, zoom, count):
+    """ Return a list of count adjacent tile coordinates near lat, lon.
+    """
+    from TileStache.Geography import SphericalMercator
+    from ModestMaps.Geo import Location
+
+    coord = SphericalMercator().locationCoordinate(Location(lat, lon)).zoomTo(zoom).container()
+
+    return [coord.right(i) for i in range(count)]
+
+def tile_extent(coord):
+    """ Return xmin, ymin, xmax, ymax of a tile in spherical mercator meters.
+    """
+    from TileStache.Geography import SphericalMercator
+
+    merc = SphericalMercator()
+    ul = merc.coordinateProj(coord)
+    lr = merc.coordinateProj(coord.down().right())
+
+    return ul.x, lr.y, lr.x, ul.y
+
+def tile_path(tiledir, coord):
+    """ Return a tile path in the layout read by Hillup.tiles.get_slope_aspect().
+    """
+    z, x, y = '%d' % coord.zoom, '%06d' % coord.column, '%06d' % coord.row
+    return join(tiledir, z, x[:3], x[3:], y[:3], y[3:]) + '.tiff'
+
+def prepare(options):
+    """ Create synthetic DEM quads for every source and zoom to be benchmarked.
+    """
+    from TileStache.Geography import SphericalMercator
+    from synthetic import make_demdir
+    from Hillup.data import dem_module, files
+
+    files.storage = options.dem_storage
+    demdir = join(options.workdir, 'source')
+    merc = SphericalMercator()
+    names = set()
+
+    for source in options.sources.split(','):
+        names.update(source_modules.get(source, ()))
+
+    modules = map(dem_module, sorted(names))
+
+    for zoom in map(int, options.zooms.split(',')):
+        coords = tile_coordinates(options.lat, options.lon, zoom, options.count)
+        nw = merc.coordinateLocation(coords[0])
+        se = merc.coordinateLocation(coords[-1].down().right())
+
+        # buffer generously to cover pixel and reprojection overlap
+        make_demdir(demdir, modules, nw.lon - .1, se.lat - .1, se.lon + .1, nw.lat + .1)
+
+def sample_elevation(size):
+    """ Return a synthetic elevation array with one pixel of buffer.
+    """
+    from synthetic import elevation
+    import numpy
+
+    steps = numpy.linspace(0, .05, size + 2)
+    lons, lats = numpy.meshgrid(steps - 122.3, 37.8 - steps)
+
+    return elevation(lons, lats).astype(numpy.float32)
+
+def run_case(options, case):
+    """ Run one named case in this process, return count of tiles processed.
+    """
+    from Hillup import read_slope_aspect, save_slope_aspect
+    from Hillup.data import Provider, calculate_slope_aspect, webmerc_sref
+    from Hillup.tiles import render_tile
+    from TileStache.Geography import SphericalMercator
+
+    demdir = join(options.workdir, 'source')
+    tiledir = join(options.workdir, 'out')
+    size, count = options.size, options.count
+
+    xres, yres = 40., -40.
+    wkt = webmerc_sref().ExportToWkt()
+    xform = 0, xres, 0, 0, 0, yres
+
+    if case.startswith('renderArea '):
+        # e.g. "renderArea srtm-ned 12"
+        ignore, source, zoom = case.split()
+        provider = Provider(None, demdir, None, source)
+        srs = SphericalMercator().srs
+
+        for coord in tile_coordinates(options.lat, options.lon, int(zoom), count):
+            xmin, ymin, xmax, ymax = tile_extent(coord)
+            tile = provider.renderArea(size, size, srs, xmin, ymin, xmax, ymax, int(zoom))
+
+            # keep the result for later render_tile cases
+            filename = tile_path(tiledir, coord)
+
+            if not exists(dirname(filename)):
+                makedirs(dirname(filename))
+
+            output = open(filename, 'w')
+            tile.save(output, 'TIFF')
+            output.close()
+
+        return count
+
+    elevation = sample_elevation(size)
+    slope, aspect = calculate_slope_aspect(elevation, xres, yres)
+
+    if case == 'calculate_slope_aspect':
+        for i in range(count):
+            calculate_slope_aspect(elevation, xres, yres)
+
+    elif case == 'save_slope_aspect':
+        for i in range(count):
+            save_slope_aspect(slope, aspect, wkt, xform, StringIO(), None)
+
+    elif case == 'read_slope_aspect':
+        handle, filename = mkstemp(prefix='hillup-bench-', suffix='.tif')
+        close(handle)
+
+        try:
+            output = open(filename, 'w')
+            save_slope_aspect(slope, aspect, wkt, xform, output, None)
+            output.close()
+
+            for i in range(count):
+                read_slope_aspect(filename)
+
+        finally:
+            unlink(filename)
+
+    elif case.startswith('render_tile '):
+        # e.g. "render_tile 12", requires a renderArea case at that zoom
+        zoom = int(case.split()[1])
+
+        for coord in tile_coordinates(options.lat, options.lon, zoom, count):
+            render_tile(tiledir, coord, zoom)
+
+    else:
+        raise Exception('Unknown benchmark case "%s"' % case)
+
+    return count
+
+def list_cases(options):
+    """ Return a list of all case names, in the order they should run.
+    """
+    zooms = options.zooms.split(',')
+    cases = []
+
+    for source in options.sources.split(','):
+        cases += ['renderArea %s %s' % (source, zoom) for zoom in zooms]
+
+    cases += ['calculate_slope_aspect', 'save_slope_aspect', 'read_slope_aspect']
+    cases += ['render_tile %s' % zoom for zoom in zooms]
+
+    return cases
+
+def spawn_case(options, case):
+    """ Run one case in a child process, return a dictionary of results.
+    """
+    args = [executable, abspath(__file__), '--case', case,
+            '--work-directory', options.workdir, '--tile-size', str(options.size),
+            '--count', str(options.count), '--zooms', options.zooms, '--sources', options.sources]
+
+    child = Popen(args, stdout=PIPE)
+    output, ignore = child.communicate()
+
+    if child.returncode != 0:
+        return dict(error='exited with %d' % child.returncode)
+
+    return json.loads(output)
+
+def report(run, previous):
+    """ Print a table of results, with change relative to a previous run.
+    """
+    print '%-32s %12s %12s %10s' % ('case', 'tiles/sec', 'peak RSS KB', 'change')
+
+    for case in run['order']:
+        result = run['cases'][case]
+
+        if 'error' in result:
+            print '%-32s %s' % (case, result['error'])
+            continue
+
+        change = ''
+        before = previous and previous['cases'].get(case)
+
+        if before and before.get('tiles_per_sec'):
+            change = '%+.1f%%' % (100. * result['tiles_per_sec'] / before['tiles_per_sec'] - 100)
+
+        print '%-32s %12.2f %12d %10s' % (case, result['tiles_per_sec'], result['peak_rss_kb'], change)
+
+if __name__ == '__main__':
+
+    options, args = parser.parse_args()
+
+    if options.case:
+        start = time()
+        count = run_case(options, options.case)
+        elapsed = time() - start
+
+        peak_rss = getrusage(RUSAGE_SELF).ru_maxrss
+        print json.dumps(dict(tiles=count, seconds=elapsed, tiles_per_sec=count/elapsed, peak_rss_kb=peak_rss))
+
+        exit(0)
+
+    cleanup = options.workdir is None
+    options.workdir = options.workdir or mkdtemp(prefix='hillup-bench-')
+
+    try:
+        print >> stderr, 'Preparing synthetic DEMs in', options.workdir
+        prepare(options)
+
+        run = dict(time=strftime('%Y-%m-%d %H:%M:%S'), label=options.label, dem_storage=options.dem_storage,
+                   size=options.size, count=options.count, cases={}, order=list_cases(options))
+
+        for case in run['order']:
+            print >> stderr, 'Running', case
+            run['cases'][case] = spawn_case(options, case)
+
+    finally:
+        if cleanup:
+            rmtree(options.workdir)
+
+    runs = json.load(open(options.results)) if exists(options.results) else []
+    previous = runs[-1] if runs else None
+
+    report(run, previous)
+
+    runs.append(run)
+    json.dump(runs, open(options.results, 'w'), indent=2)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+""" Import-time benchmark for Hillup packages.
+
+Each package is imported in a fresh interpreter several times, and the
+median time is reported along with any heavy modules that came along with
+it. Heavy modules that a package is expected not to load are an error, so
+this exits with a non-zero status if lazy imports ever regress.
+"""
+from sys import executable, exit, stderr
+from os.path import abspath, dirname
+from subprocess import Popen, PIPE
+from optparse import OptionParser
+import json
+
+root = dirname(dirname(abspath(__file__)))
+
+parser = OptionParser(usage="""%prog [options]
+
+Report import times of Hillup, Hillup.tiles and Hillup.data.
+
+See `%prog --help` for info.""")
+
+defaults = dict(runs=5)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-n', '--runs', dest='runs', type='int',
+                  help='Number of fresh interpreters per package, default %(runs)s.' % defaults)
+
+#
+# Modules that each package must not import on its own. Hillup.data needs
+# TileStache.Core for SeedingLayer, and TileStache's own __init__ imports
+# Config and Caches, so those can't be forbidden there. Nor can osgeo.osr,
+# which TileStache.Vector imports by way of Config whenever GDAL is there.
+#
+
+dem_modules = ['Hillup.data.' + name for name in ('NED10m', 'NED100m', 'NED1km', 'SRTM1', 'SRTM3', 'VFP', 'Worldwide')]
+
+forbidden = {
+    'Hillup': ['osgeo.gdal', 'osgeo.osr', 'PIL.Image', 'TileStache', 'Hillup.data', 'Hillup.tiles', 'multiprocessing.pool'],
+    'Hillup.tiles': ['osgeo.gdal', 'osgeo.osr', 'TileStache', 'Hillup.data', 'urllib', 'multiprocessing.pool'],
+    'Hillup.data': ['osgeo.gdal'] + dem_modules
+    }
+
+#
+# Heavy modules worth reporting when present.
+#
+
+watched = ['numpy', 'PIL.Image', 'osgeo.gdal', 'osgeo.osr', 'TileStache', 'TileStache.Core', 'TileStache.Config', 'TileStache.Caches'] + dem_modules
+
+timer = """
+import sys, time, json
+start = time.time()
+import %(package)s
+elapsed = time.time() - start
+print json.dumps(dict(seconds=elapsed, modules=[name for name in sys.modules if sys.modules[name]]))
+"""
+
+def time_import(package):
+    """ Import a package in a fresh interpreter, return seconds and loaded modules.
+    """
+    child = Popen([executable, '-c', timer % locals()], cwd=root, stdout=PIPE)
+    output, ignore = child.communicate()
+
+    if child.returncode != 0:
+        raise Exception('Importing %s failed' % package)
+
+    result = json.loads(output)
+    return result['seconds'], set(result['modules'])
+
+if __name__ == '__main__':
+
+    options, args = parser.parse_args()
+    failed = False
+
+    print '%-16s %10s  %s' % ('package', 'median ms', 'heavy modules loaded')
+
+    for package in ('Hillup', 'Hillup.tiles', 'Hillup.data'):
+        results = [time_import(package) for i in range(options.runs)]
+        seconds = sorted([seconds for (seconds, modules) in results])[len(results) / 2]
+        modules = results[-1][1]
+
+        print '%-16s %10.1f  %s' % (package, seconds * 1000, ', '.join([name for name in watched if name in modules]) or '-')
+
+        for name in forbidden[package]:
+            if name in modules:
+                print >> stderr, 'Importing %s should not load %s' % (package, name)
+                failed = True
+
+    exit(1 if failed else 0)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+""" Load test comparing tile servers, e.g. render/tile.cgi and render/tile-server.py.
+
+Each target is either a base URL such as "http://localhost:8080/hills" or
+a path to a CGI script such as "render/tile.cgi", which is then run once per
+request exactly as a web server would, to measure the cost of the CGI path
+without needing one installed.
+
+    python bench/loadtest.py render/tile.cgi http://localhost:8080/hills
+"""
+from sys import executable
+from os import environ
+from os.path import abspath, dirname, exists
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+from threading import Thread, Lock
+from urllib import urlopen
+from time import time
+
+parser = OptionParser(usage="""%prog [options] target [target...]
+
+Request the same set of tiles from every target and report requests/sec
+and latency percentiles.
+
+See `%prog --help` for info.""")
+
+defaults = dict(layer='hills', zoom=13, column=1313, row=3165, span=4, requests=200, concurrency=4)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name, used only for CGI targets, default "%(layer)s".' % defaults)
+
+parser.add_option('-z', '--zoom', dest='zoom', type='int',
+                  help='Zoom level of requested tiles, default %(zoom)s.' % defaults)
+
+parser.add_option('-x', '--column', dest='column', type='int',
+                  help='Leftmost column of requested tiles, default %(column)s.' % defaults)
+
+parser.add_option('-y', '--row', dest='row', type='int',
+                  help='Topmost row of requested tiles, default %(row)s.' % defaults)
+
+parser.add_option('--span', dest='span', type='int',
+                  help='Width and height in tiles of the requested block, default %(span)s.' % defaults)
+
+parser.add_option('-n', '--requests', dest='requests', type='int',
+                  help='Total number of requests per target, default %(requests)s.' % defaults)
+
+parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                  help='Number of simultaneous requests, default %(concurrency)s.' % defaults)
+
+def request_cgi(script, path_info):
+    """ Run a CGI script for one tile, return its output.
+    """
+    env = dict(environ, GATEWAY_INTERFACE='CGI/1.1', REQUEST_METHOD='GET',
+               PATH_INFO=path_info, QUERY_STRING='', SCRIPT_NAME='/tile.cgi',
+               SERVER_NAME='localhost', SERVER_PORT='80')
+
+    child = Popen([executable, abspath(script)], cwd=dirname(abspath(script)), env=env, stdout=PIPE)
+    output, ignore = child.communicate()
+
+    if child.returncode != 0:
+        raise Exception('CGI exited with %d' % child.returncode)
+
+    return output
+
+def request_url(base_url, path_info):
+    """ Request one tile over HTTP, return its body.
+    """
+    resp = urlopen(base_url.rstrip('/') + path_info)
+
+    if resp.getcode() != 200:
+        raise Exception('HTTP status %d' % resp.getcode())
+
+    return resp.read()
+
+def tile_paths(options):
+    """ Return a list of path_info strings for a block of tiles.
+    """
+    return ['/%d/%d/%d.png' % (options.zoom, options.column + x, options.row + y)
+            for y in range(options.span) for x in range(options.span)]
+
+def percentile(values, fraction):
+    """ Return a simple nearest-rank percentile of a list of values.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def load_test(target, options):
+    """ Run a load test against one target, return a dictionary of results.
+    """
+    if exists(target):
+        request = lambda path: request_cgi(target, '/%s%s' % (options.layer, path))
+    else:
+        request = lambda path: request_url(target, path)
+
+    paths = tile_paths(options)
+    queue = [paths[i % len(paths)] for i in range(options.requests)]
+    latencies, errors = [], []
+    lock = Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                path = queue.pop()
+
+            start = time()
+
+            try:
+                request(path)
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+            else:
+                with lock:
+                    latencies.append(time() - start)
+
+    threads = [Thread(target=work) for i in range(options.concurrency)]
+    start = time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time() - start
+
+    return dict(target=target, requests=len(latencies), errors=len(errors),
+                rps=len(latencies) / elapsed,
+                p50=latencies and percentile(latencies, .50),
+                p99=latencies and percentile(latencies, .99))
+
+if __name__ == '__main__':
+
+    options, targets = parser.parse_args()
+
+    if not targets:
+        parser.error('At least one target is required.')
+
+    print '%-40s %8s %6s %10s %10s %10s' % ('target', 'requests', 'errors', 'req/sec', 'p50 ms', 'p99 ms')
+
+    for target in targets:
+        result = load_test(target, options)
+
+        print '%-40s %8d %6d %10.2f %10.1f %10.1f' \
+            % (target[-40:], result['requests'], result['errors'], result['rps'],
+               1000 * (result['p50'] or 0), 1000 * (result['p99'] or 0))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+""" Speed and image difference of Hillup.data.Provider quality tiers.
+
+The same tiles are rendered from synthetic DEM quads at every quality tier,
+then shaded and quantized to 8 bits as Hillup.tiles would show them. Each
+tier is compared pixel by pixel with the "high" tier, so the cost in image
+quality can be weighed against tiles/sec at each zoom.
+
+    python bench/quality.py --zooms 8,10,12,14 --sources srtm-ned
+"""
+from sys import stderr
+from os.path import join
+from optparse import OptionParser
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+
+from benchmark import prepare, tile_coordinates, tile_extent
+
+parser = OptionParser(usage="""%prog [options]
+
+Report tiles/sec and difference from "high" for each quality tier.
+
+See `%prog --help` for info.""")
+
+defaults = dict(zooms='8,10,12,14', sources='srtm-ned', tiers='high,normal,draft',
+                size=256, count=4, workdir=None, lat=37.80, lon=-122.30, dem_storage='raw')
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-z', '--zooms', dest='zooms',
+                  help='Comma-separated zoom levels, default "%(zooms)s".' % defaults)
+
+parser.add_option('-s', '--sources', dest='sources',
+                  help='Comma-separated Hillup.data.Provider sources, default "%(sources)s".' % defaults)
+
+parser.add_option('-q', '--tiers', dest='tiers',
+                  help='Comma-separated quality tiers, compared with the first. Default "%(tiers)s".' % defaults)
+
+parser.add_option('--tile-size', dest='size', type='int',
+                  help='Size of rendered tiles, default %(size)s.' % defaults)
+
+parser.add_option('-n', '--count', dest='count', type='int',
+                  help='Number of tiles per zoom, default %(count)s.' % defaults)
+
+parser.add_option('-w', '--work-directory', dest='workdir',
+                  help='Directory for synthetic DEMs, kept between runs. Default is a temporary directory.')
+
+def render(provider, coords, size):
+    """ Render a list of tiles, return seconds taken and 8-bit shaded arrays.
+    """
+    from Hillup import shade_hills
+    from Hillup.data import webmerc_proj
+
+    start, tiles = time(), []
+
+    for coord in coords:
+        xmin, ymin, xmax, ymax = tile_extent(coord)
+        tiles.append(provider.renderArea(size, size, webmerc_proj.srs, xmin, ymin, xmax, ymax, int(coord.zoom)))
+
+    elapsed = time() - start
+    shaded = []
+
+    for tile in tiles:
+        if hasattr(tile, 'slope'):
+            shaded.append((0xFF * shade_hills(tile.slope, tile.aspect).clip(0, 1)).astype('uint8'))
+        else:
+            shaded.append(None)
+
+    return elapsed, shaded
+
+def difference(images, references):
+    """ Return mean and max absolute difference, and fraction of pixels changed.
+    """
+    import numpy
+
+    diffs = [numpy.abs(image.astype(int) - reference.astype(int))
+             for (image, reference) in zip(images, references)
+             if image is not None and reference is not None]
+
+    if not diffs:
+        return 0., 0, 0.
+
+    diffs = numpy.array(diffs)
+
+    return diffs.mean(), diffs.max(), (diffs > 0).mean()
+
+if __name__ == '__main__':
+
+    from Hillup.data import Provider
+
+    options, args = parser.parse_args()
+    tiers = options.tiers.split(',')
+
+    cleanup = options.workdir is None
+    options.workdir = options.workdir or mkdtemp(prefix='hillup-quality-')
+
+    try:
+        print >> stderr, 'Preparing synthetic DEMs in', options.workdir
+        prepare(options)
+
+        print '%-10s %5s %-8s %10s %8s %10s %9s %9s' % ('source', 'zoom', 'tier', 'tiles/sec', 'speedup', 'mean diff', 'max diff', 'changed')
+
+        for source in options.sources.split(','):
+            for zoom in map(int, options.zooms.split(',')):
+                coords = tile_coordinates(options.lat, options.lon, zoom, options.count)
+                reference_rate, references = None, None
+
+                for tier in tiers:
+                    provider = Provider(None, join(options.workdir, 'source'), None, source, quality=tier)
+                    elapsed, images = render(provider, coords, options.size)
+                    rate = len(coords) / elapsed
+
+                    if references is None:
+                        reference_rate, references = rate, images
+
+                    mean, most, changed = difference(images, references)
+
+                    print '%-10s %5d %-8s %10.2f %7.2fx %10.3f %9d %8.1f%%' \
+                        % (source, zoom, tier, rate, rate / reference_rate, mean, most, changed * 100)
+
+    finally:
+        if cleanup:
+            rmtree(options.workdir)
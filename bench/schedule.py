@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+""" Simulated DEM I/O of hillup-seed.py tile orders.
+
+Tiles are generated exactly as hillup-seed.py would for each --order, and
+the DEM reads each one needs are replayed against two least-recently-used
+caches: a small number of open 1-degree quads, and a page cache that holds
+horizontal strips of quad files. Nothing is rendered or downloaded, so this
+runs in seconds for regions that would take days to seed.
+
+    python bench/schedule.py -b 36 -124 41 -119 8 9 10 11 12 13
+"""
+from sys import path
+from os.path import abspath, dirname, join
+from optparse import OptionParser
+from collections import OrderedDict
+from math import floor
+import imp
+
+root = dirname(dirname(abspath(__file__)))
+path.insert(0, root)
+
+from TileStache.Geography import SphericalMercator
+from ModestMaps.Geo import Location
+
+from Hillup.data.masks import coordinate_bbox
+
+seed = imp.load_source('hillup_seed', join(root, 'hillup-seed.py'))
+
+parser = OptionParser(usage="""%prog [options] [zoom...]
+
+Compare DEM quad opens and bytes read for each tile order of hillup-seed.py.
+
+See `%prog --help` for info.""")
+
+defaults = dict(bbox=(36, -124, 41, -119), orders='rows,zorder,hilbert',
+                open_quads=4, cache_mb=256, quad_mb=25.9, strips=64)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-b', '--bbox', dest='bbox', type='float', nargs=4,
+                  help='Bounding box in floating point geographic coordinates: south west north east, default (%.3f, %.3f, %.3f, %.3f).' % defaults['bbox'])
+
+parser.add_option('-o', '--orders', dest='orders',
+                  help='Comma-separated tile orders to compare, default "%(orders)s".' % defaults)
+
+parser.add_option('--open-quads', dest='open_quads', type='int',
+                  help='Number of DEM quads kept open at once, default %(open_quads)s.' % defaults)
+
+parser.add_option('--cache-mb', dest='cache_mb', type='float',
+                  help='Size of simulated page cache in megabytes, default %(cache_mb)s.' % defaults)
+
+parser.add_option('--quad-mb', dest='quad_mb', type='float',
+                  help='Size of one DEM quad file in megabytes, default %(quad_mb)s for SRTM1.' % defaults)
+
+parser.add_option('--strips', dest='strips', type='int',
+                  help='Number of horizontal strips each quad file is read in, default %(strips)s.' % defaults)
+
+class LRU:
+    """ Least-recently-used set with a fixed capacity, counting misses.
+    """
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.items = OrderedDict()
+        self.misses = 0
+
+    def use(self, key):
+        if key in self.items:
+            del self.items[key]
+
+        else:
+            self.misses += 1
+
+            if len(self.items) >= self.capacity:
+                self.items.popitem(last=False)
+
+        self.items[key] = True
+
+def tile_reads(coord, strips):
+    """ Generate (quad, strip) pairs a tile reads, with quads keyed by southwest corner.
+    """
+    west, south, east, north = coordinate_bbox(coord)
+
+    for lon in range(int(floor(west)), int(floor(east)) + 1):
+        for lat in range(int(floor(south)), int(floor(north)) + 1):
+            top = min(strips - 1, int((min(north, lat + 1) - lat) * strips))
+            bottom = max(0, int((max(south, lat) - lat) * strips))
+
+            for strip in range(bottom, top + 1):
+                yield (lon, lat), strip
+
+def simulate(tiles, options):
+    """ Return count of tiles, quad opens and megabytes read for a stream of tiles.
+    """
+    quads = LRU(options.open_quads)
+    pages = LRU(int(options.cache_mb * options.strips / options.quad_mb))
+    count = 0
+
+    for (offset, total, coord) in tiles:
+        opened = set()
+
+        for (quad, strip) in tile_reads(coord, options.strips):
+            if quad not in opened:
+                quads.use(quad)
+                opened.add(quad)
+
+            pages.use((quad, strip))
+
+        count += 1
+
+    return count, quads.misses, pages.misses * options.quad_mb / options.strips
+
+if __name__ == '__main__':
+
+    options, zooms = parser.parse_args()
+    zooms = map(int, zooms or (8, 9, 10, 11, 12, 13))
+
+    lat1, lon1, lat2, lon2 = options.bbox
+    merc = SphericalMercator()
+
+    ul = merc.locationCoordinate(Location(max(lat1, lat2), min(lon1, lon2)))
+    lr = merc.locationCoordinate(Location(min(lat1, lat2), max(lon1, lon2)))
+
+    print '%-10s %8s %12s %12s' % ('order', 'tiles', 'quad opens', 'MB read')
+
+    for order in options.orders.split(','):
+        tiles = seed.generateCoordinates(ul, lr, zooms, 0, None, order)
+        count, opens, megabytes = simulate(tiles, options)
+
+        print '%-10s %8d %12d %12.1f' % (order, count, opens, megabytes)
@@ -0,0 +1,154 @@
+""" Synthetic DEM quads for offline benchmarking.
+
+Each DEM module is given fake elevation files in exactly the local layout its
+datasource() function expects, so that no remote host is ever contacted.
+"""
+from os import makedirs
+from os.path import basename, dirname, isdir, join
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from osgeo import gdal
+
+import numpy
+
+from Hillup.data.files import stored_dem, ingest
+
+#
+# Samples per side of one 1-degree quad for each module. NED10m is really
+# 10812 samples on a side, but that's about 470MB per quad of floats, so
+# a smaller number is used by default and can be overriden.
+#
+quad_samples = dict(SRTM3=1201, SRTM1=3601, VFP=1201, NED10m=2701, NED100m=1201, NED1km=121)
+
+#
+# Quad corner conventions for each module: southwest or northwest.
+#
+northwest_modules = 'NED10m', 'NED100m', 'NED1km'
+
+def module_name(module):
+    """ Return the short name of a DEM module, e.g. "SRTM3".
+    """
+    return module.__name__.split('.')[-1]
+
+def elevation(lons, lats):
+    """ Return a smooth, continuous field of elevations in meters.
+
+        Some hills, some valleys, and some ground below sea level.
+    """
+    return 400 * numpy.sin(lons * 7.1) * numpy.cos(lats * 5.3) \
+         + 250 * numpy.sin(lons * 31.0 + lats * 17.0) \
+         + 60 * numpy.cos(lons * 173.0 - lats * 151.0) \
+         + 300
+
+def quad_grid(west, north, samples):
+    """ Return 2D arrays of lon, lat for a 1-degree quad with edge overlap.
+    """
+    steps = numpy.linspace(0, 1, samples)
+    lons, lats = numpy.meshgrid(west + steps, north - steps)
+
+    return lons, lats
+
+def write_hgt(path, west, south, samples):
+    """ Write an SRTM-style big-endian 16-bit .hgt file.
+    """
+    lons, lats = quad_grid(west, south + 1, samples)
+    elevation(lons, lats).astype('>i2').tofile(path)
+
+def write_flt(path, west, north, samples):
+    """ Write a NED-style .flt/.hdr/.prj triplet of raw floats.
+    """
+    base = path[:-4]
+    lons, lats = quad_grid(west, north, samples)
+    elevation(lons, lats).astype('<f4').tofile(base + '.flt')
+
+    cellsize = 1. / (samples - 1)
+
+    hdr = open(base + '.hdr', 'w')
+    print >> hdr, 'ncols', samples
+    print >> hdr, 'nrows', samples
+    print >> hdr, 'xllcorner', west - cellsize/2
+    print >> hdr, 'yllcorner', north - 1 - cellsize/2
+    print >> hdr, 'cellsize', cellsize
+    print >> hdr, 'NODATA_value', -9999
+    print >> hdr, 'byteorder LSBFIRST'
+    print >> hdr, 'nbits 32'
+    print >> hdr, 'pixeltype float'
+    hdr.close()
+
+    print >> open(base + '.prj', 'w'), 'GEOGCS["NAD83",DATUM["North_American_Datum_1983",SPHEROID["GRS 1980",6378137,298.257222101]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'
+
+def write_tif(path, west, north, samples, sref):
+    """ Write a single-band floating point GeoTIFF.
+    """
+    lons, lats = quad_grid(west, north, samples)
+    cellsize = 1. / (samples - 1)
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, samples, samples, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((west - cellsize/2, cellsize, 0, north + cellsize/2, 0, -cellsize))
+    ds.SetProjection(sref.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(elevation(lons, lats).astype(numpy.float32), 0, 0)
+    ds.GetRasterBand(1).SetNoDataValue(-9999)
+    ds.FlushCache()
+
+def write_quad(module, lat, lon, demdir, samples=None):
+    """ Write one synthetic quad for a DEM module, return its local path.
+
+        Return None for quads that the module says are outside coverage.
+        Quads are stored in the form set by Hillup.data.files.storage.
+    """
+    name = module_name(module)
+    samples = samples or quad_samples[name]
+
+    try:
+        url, dem_path, dem_none = module.locate(lat, lon, demdir)
+    except ValueError:
+        return None
+
+    if stored_dem(dem_path):
+        return stored_dem(dem_path)
+
+    if not isdir(dirname(dem_path)):
+        makedirs(dirname(dem_path))
+
+    try:
+        dirpath = mkdtemp(prefix='synthetic-', dir=dirname(dem_path))
+        tmp_path = join(dirpath, basename(dem_path))
+
+        if name in ('SRTM3', 'SRTM1', 'VFP'):
+            write_hgt(tmp_path, lon, lat, samples)
+
+        elif name == 'NED10m':
+            write_flt(tmp_path, lon, lat, samples)
+
+        elif name in ('NED100m', 'NED1km'):
+            write_tif(tmp_path, lon, lat, samples, module.sref)
+
+        else:
+            raise Exception('Unknown DEM module "%s"' % name)
+
+        ingest(dem_path, dirpath)
+
+    finally:
+        rmtree(dirpath)
+
+    return stored_dem(dem_path)
+
+def make_demdir(demdir, modules, minlon, minlat, maxlon, maxlat, samples=None):
+    """ Fill a DEM directory with synthetic quads covering a bounding box.
+
+        Samples is an optional dictionary of per-module sample counts.
+    """
+    samples = samples or {}
+    paths = []
+
+    for module in modules:
+        for (lon, lat) in module.quads(minlon, minlat, maxlon, maxlat):
+            name = module_name(module)
+            path = write_quad(module, int(lat), int(lon), demdir, samples.get(name))
+
+            if path:
+                paths.append(path)
+
+    return paths
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+""" Size, speed and accuracy of each slope and aspect tile codec.
+
+One synthetic tile of slope and aspect is saved with every codec in
+Hillup.codecs, then read back. Reported are bytes per tile, milliseconds
+to encode with save_slope_aspect() and to decode with read_slope_aspect(),
+and the largest error in 8-bit slope or aspect values after a round trip.
+
+    python bench/tile_codecs.py --tile-size 512
+"""
+from os import close, unlink
+from os.path import getsize
+from optparse import OptionParser
+from tempfile import mkstemp
+from time import time
+
+from benchmark import sample_elevation
+
+parser = OptionParser(usage="""%prog [options]
+
+Report bytes, encode time, decode time and error for each tile codec.
+
+See `%prog --help` for info.""")
+
+defaults = dict(size=256, count=20, codecs='jpeg,deflate,zstd,lzw,raw')
+
+parser.set_defaults(**defaults)
+
+parser.add_option('--tile-size', dest='size', type='int',
+                  help='Size of tiles, default %(size)s.' % defaults)
+
+parser.add_option('-n', '--count', dest='count', type='int',
+                  help='Number of times to encode and decode each tile, default %(count)s.' % defaults)
+
+parser.add_option('-c', '--codecs', dest='codecs',
+                  help='Comma-separated codecs to compare, default "%(codecs)s".' % defaults)
+
+def measure(codec, slope, aspect, wkt, xform, count):
+    """ Return bytes, seconds to encode, seconds to decode and max error for one codec.
+    """
+    from Hillup import save_slope_aspect, read_slope_aspect, slope2bytes, aspect2bytes
+    from osgeo import gdal
+    import numpy
+
+    handle, filename = mkstemp(prefix='hillup-codec-', suffix='.tif')
+    close(handle)
+
+    try:
+        start = time()
+
+        for i in range(count):
+            output = open(filename, 'w')
+            save_slope_aspect(slope, aspect, wkt, xform, output, None, codec)
+            output.close()
+
+        encode = (time() - start) / count
+        start = time()
+
+        for i in range(count):
+            read_slope_aspect(filename)
+
+        decode = (time() - start) / count
+
+        # compare stored bytes directly, since conversion back to radians is lossy.
+        ds = gdal.Open(filename)
+        slope_error = numpy.abs(ds.GetRasterBand(1).ReadAsArray().astype(int) - slope2bytes(slope)).max()
+        aspect_error = numpy.abs(ds.GetRasterBand(2).ReadAsArray().astype(int) - aspect2bytes(aspect)).max()
+        ds = None
+
+        return getsize(filename), encode, decode, max(slope_error, aspect_error)
+
+    finally:
+        unlink(filename)
+
+if __name__ == '__main__':
+
+    from Hillup.data import calculate_slope_aspect, webmerc_sref
+
+    options, args = parser.parse_args()
+
+    xres, yres = 40., -40.
+    wkt = webmerc_sref().ExportToWkt()
+    xform = 0, xres, 0, 0, 0, yres
+
+    slope, aspect = calculate_slope_aspect(sample_elevation(options.size), xres, yres)
+
+    print '%-8s %10s %10s %10s %10s' % ('codec', 'bytes', 'encode ms', 'decode ms', 'max error')
+
+    for codec in options.codecs.split(','):
+        try:
+            bytes, encode, decode, error = measure(codec, slope, aspect, wkt, xform, options.count)
+        except Exception, e:
+            # e.g. ZSTD with a GDAL that doesn't have it
+            print '%-8s %s' % (codec, e)
+            continue
+
+        print '%-8s %10d %10.2f %10.2f %10d' % (codec, bytes, encode * 1000, decode * 1000, error)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+"""
+from sys import stderr
+from optparse import OptionParser
+
+from Hillup.data.budget import usage, evict, parse_size, module_names
+
+parser = OptionParser(usage="""%prog [options] usage
+       %prog [options] --budget <size> evict
+
+Report disk usage of a DEM directory per source module, or delete the least
+recently used DEM files until the directory fits in a size budget such as
+"20G" or "500M". Evicted files are downloaded again when next needed.
+
+See `%prog --help` for info.""")
+
+defaults = dict(demdir='source', budget=None)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-d', '--dem-directory', dest='demdir',
+                  help='Directory for raw source elevation files, default "%(demdir)s".' % defaults)
+
+parser.add_option('-b', '--budget', dest='budget',
+                  help='Size budget for the DEM directory when evicting, e.g. "20G".')
+
+def print_usage(demdir):
+    """ Print a table of quads and bytes per DEM module.
+    """
+    usages = usage(demdir)
+    total_count, total_size = 0, 0
+
+    print '%-10s %8s %12s' % ('module', 'quads', 'MB')
+
+    for name in module_names:
+        count, size = usages[name]
+        total_count, total_size = total_count + count, total_size + size
+
+        print '%-10s %8d %12.1f' % (name, count, size / 1048576.)
+
+    print '%-10s %8d %12.1f' % ('total', total_count, total_size / 1048576.)
+
+if __name__ == '__main__':
+
+    options, args = parser.parse_args()
+
+    try:
+        budget = options.budget and parse_size(options.budget)
+    except ValueError:
+        parser.error('Unrecognized --budget "%s", expected a size like "20G".' % options.budget)
+
+    if args == ['usage']:
+        print_usage(options.demdir)
+
+    elif args == ['evict']:
+        if options.budget is None:
+            parser.error('Evicting requires a --budget.')
+
+        evicted = evict(options.demdir, budget)
+
+        for (name, lat, lon, size) in evicted:
+            print >> stderr, 'Evicted %s quad %d, %d (%d bytes)' % (name, lat, lon, size)
+
+        print >> stderr, 'Evicted %d quads, %.1f MB' % (len(evicted), sum([size for (n, a, o, size) in evicted]) / 1048576.)
+
+    else:
+        parser.error('Expected one command, "usage" or "evict".')
@@ -1,17 +1,26 @@
 #!/usr/bin/env python
 """
 """
-from sys import path
+from sys import exit, path, stderr, stdout
 from os.path import exists
 from optparse import OptionParser
+import json
 
 from TileStache import getTile
+from TileStache.Core import KnownUnknown
 from TileStache.Geography import SphericalMercator
 
 from ModestMaps.Core import Coordinate
 from ModestMaps.Geo import Location
 
-from Hillup.data import SeedingLayer
+from Hillup import default_lights
+from Hillup.data import SeedingLayer, files
+from Hillup.data.budget import evict, parse_size
+from Hillup.data.plan import Plan
+from Hillup.data.masks import load_polygon, coordinate_bbox, source_modules, CoverageMask, AllMasks
+
+# number of tiles between checks of the DEM directory size budget.
+budget_interval = 100
 
 parser = OptionParser(usage="""%prog [options] [zoom...]
 
@@ -20,7 +29,7 @@ Bounding box is given as a pair of lat/lon coordinates, e.g. "37.788 -122.349
 
 See `%prog --help` for info.""")
 
-defaults = dict(demdir='source', tiledir='out', tmpdir=None, source='worldwide', bbox=(37.777, -122.352, 37.839, -122.086), size=256)
+defaults = dict(demdir='source', tiledir='out', tmpdir=None, source='worldwide', bbox=(37.777, -122.352, 37.839, -122.086), size=256, threads=1, dedup=False, dem_storage='raw', dem_budget=None, polygon=None, coverage_mask=False, order='rows', plan=False, quality='high', warpdir=None, codec='jpeg', pngdir=None, png_lights=None)
 
 parser.set_defaults(**defaults)
 
@@ -35,7 +44,7 @@ parser.add_option('-t', '--tile-directory', dest='tiledir',
                   help='Directory for generated slope/aspect tiles, default "%(tiledir)s". This directory will be used as the "source_dir" for Hillup.tiles:Provider shaded renderings.' % defaults)
 
 parser.add_option('--tile-list', dest='tile_list',
-                  help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox.')
+                  help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates, seeded in the order given. Overrides --bbox.')
 
 parser.add_option('-s', '--source', dest='source',
                   help='Data source for elevations. One of "srtm-ned" for SRTM and NED data, "ned-only" for US-only downsample NED, "vfp" for Viewfinder Panoramas and SRTM3, "worldwide" for combined datasets (currently SRTM3 + VFP), or a function path such as "Module.Submodule:Function". Default "%(source)s".' % defaults)
@@ -46,36 +55,198 @@ parser.add_option('--tmp-directory', dest='tmpdir',
 parser.add_option('--tile-size', dest='size', type='int',
                   help='Optional size for rendered tiles, default %(size)s.' % defaults)
 
-def generateCoordinates(ul, lr, zooms, padding):
+parser.add_option('--threads', dest='threads', type='int',
+                  help='Optional number of threads for calculating slope and aspect of large tiles, default %(threads)s.' % defaults)
+
+parser.add_option('--dedup', dest='dedup', action='store_true',
+                  help='Store identical tiles only once, as hardlinks to a shared copy under "blobs" in the tile directory.')
+
+parser.add_option('--dem-storage', dest='dem_storage', type='choice', choices=('raw', 'zip', 'deflate'),
+                  help='Form for newly-downloaded DEM files: "raw" uncompressed rasters, "zip" archives read through GDAL\'s /vsizip, or "deflate" compressed GeoTIFFs. Existing files in any form are always used. Default "%(dem_storage)s".' % defaults)
+
+parser.add_option('--polygon', dest='polygon',
+                  help='Optional GeoJSON file of polygons. Only tiles that intersect them are generated, within --bbox.')
+
+parser.add_option('--coverage-mask', dest='coverage_mask', action='store_true',
+                  help='Skip tiles where earlier downloads have found no elevation data for the chosen --source.')
+
+parser.add_option('--order', dest='order', type='choice', choices=('rows', 'zorder', 'hilbert'),
+                  help='Order of generated tiles: "rows" for each zoom in turn row by row, or "zorder" or "hilbert" to render all zooms over one area along a space-filling curve before moving on, which keeps DEM data in cache. Default "%(order)s".' % defaults)
+
+parser.add_option('--quality', dest='quality', type='choice', choices=('draft', 'normal', 'high'),
+                  help='Quality of DEM resampling: "high" for cubic everywhere, "normal" for faster bilinear at zoom 10 and below, or "draft" for fastest resampling at all zooms, good for previews. Default "%(quality)s".' % defaults)
+
+parser.add_option('--warp-directory', dest='warpdir',
+                  help='Optional directory for keeping warped elevation from each DEM source at zoom levels that blend two sources, so re-seeding them skips warping. Uses about 4 bytes per pixel per source.')
+
+parser.add_option('--codec', dest='codec', type='choice', choices=('jpeg', 'deflate', 'zstd', 'lzw', 'raw'),
+                  help='Compression of slope and aspect GeoTIFFs: lossy "jpeg", lossless "deflate", "zstd" or "lzw", or uncompressed "raw". Hillup.tiles reads any of them. Default "%(codec)s".' % defaults)
+
+parser.add_option('--png-directory', dest='pngdir',
+                  help='Optional directory for shaded PNG tiles rendered in the same pass as slope and aspect, laid out like a TileStache disk cache of one layer. Use e.g. "cache/hills" to fill the cache of a "hills" layer.')
+
+parser.add_option('--png-lights', dest='png_lights',
+                  help='Optional lights for --png-directory tiles, as JSON like the "lights" kwarg of the layer they\'re for, e.g. "[[315, 45, 1, 1]]". Default Hillup.default_lights.')
+
+parser.add_option('--plan', dest='plan', action='store_true',
+                  help='Print an estimate of tiles, DEM downloads, disk space and CPU time per zoom and source module, without downloading or rendering anything.')
+
+parser.add_option('--dem-budget', dest='dem_budget',
+                  help='Optional size budget for the DEM directory such as "20G", kept by deleting least recently used DEM files every %d tiles. See also hillup-dem.py.' % budget_interval)
+
+def generateCoordinates(ul, lr, zooms, padding, mask=None, order='rows'):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+    
+        Optional mask is an object from Hillup.data.masks, and tiles outside
+        of it are skipped along with all of their children.
+        
+        Order is "rows" for each zoom in turn row by row, or "zorder" or
+        "hilbert" for all zooms at once along a space-filling curve. With
+        a curve, each tile is followed by its own children before moving on,
+        so every zoom over one area is rendered while its DEM data is hot.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    rects = dict()
     
     for zoom in zooms:
         ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
         lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
         
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
+        rects[zoom] = ul_, lr_
+    
+    # start with a simple total of all the coordinates we will need.
+    count = 0
+    
+    if mask is None and order == 'rows':
+        for zoom in zooms:
+            ul_, lr_ = rects[zoom]
+            
+            rows = lr_.row + 1 - ul_.row
+            cols = lr_.column + 1 - ul_.column
+            
+            count += int(rows * cols)
+    
+    else:
+        for coord in orderedCoordinates(rects, zooms, mask, order):
+            count += 1
 
     # now generate the actual coordinates.
     # offset starts at zero
     offset = 0
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    for coord in orderedCoordinates(rects, zooms, mask, order):
+        yield (offset, count, coord)
+        
+        offset += 1
 
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
+def orderedCoordinates(rects, zooms, mask, order):
+    """ Generate coordinates for a dictionary of (ul, lr) rectangles by zoom.
+    """
+    if order == 'rows' and mask is None:
+        for zoom in zooms:
+            ul, lr = rects[zoom]
+            
+            for row in range(int(ul.row), int(lr.row + 1)):
+                for column in range(int(ul.column), int(lr.column + 1)):
+                    yield Coordinate(row, column, zoom)
+    
+    elif order == 'rows':
+        # one row at a time, where Z-order is left to right.
+        for zoom in zooms:
+            ul, lr = rects[zoom]
+            
+            for row in range(int(ul.row), int(lr.row + 1)):
+                rect = Coordinate(row, ul.column, zoom), Coordinate(row, lr.column, zoom)
                 
-                offset += 1
+                for coord in quadtreeCoordinates({zoom: rect}, mask, 'zorder'):
+                    yield coord
+    
+    elif order in ('zorder', 'hilbert'):
+        for coord in quadtreeCoordinates(rects, mask, order):
+            yield coord
+    
+    else:
+        raise KnownUnknown('"%s" is not a known tile order.' % order)
+
+def quadtreeCoordinates(rects, mask, curve):
+    """ Generate coordinates inside a dictionary of (ul, lr) rectangles by zoom.
+    
+        Descends the quadtree from zoom 0, skipping whole branches outside
+        the mask or all of the rectangles, and stops checking the mask under
+        tiles that are entirely within it. Each tile comes out just before
+        its children, which are visited in reading order for "zorder" or
+        along a Hilbert curve for "hilbert".
+    """
+    deepest = max(rects)
+    stack = [(Coordinate(0, 0, 0), mask is None)]
+    
+    while stack:
+        coord, inside = stack.pop()
+        
+        # skip branches that don't reach into any rectangle.
+        if not [zoom for zoom in rects if zoom >= coord.zoom and reaches(coord, zoom, *rects[zoom])]:
+            continue
+        
+        if not inside:
+            bbox = coordinate_bbox(coord)
+            
+            if not mask.intersects(*bbox):
+                continue
+            
+            inside = mask.contains(*bbox)
+        
+        if coord.zoom in rects and reaches(coord, coord.zoom, *rects[coord.zoom]):
+            yield coord
+        
+        if coord.zoom == deepest:
+            continue
+        
+        child = coord.zoomBy(1)
+        children = [Coordinate(child.row + row, child.column + column, child.zoom)
+                    for (row, column) in ((0, 0), (0, 1), (1, 0), (1, 1))]
+        
+        if curve == 'hilbert':
+            # compare at the deepest zoom, so the curve is the same at every level.
+            shift = deepest - child.zoom
+            children.sort(key=lambda c: hilbertIndex(deepest, int(c.column) << shift, int(c.row) << shift))
+        
+        # push children in reverse, so they come out in order.
+        for c in reversed(children):
+            stack.append((c, inside))
+
+def reaches(coord, zoom, ul, lr):
+    """ Return true if a coordinate or its children reach into a rectangle at a zoom.
+    """
+    scale = 2 ** (zoom - coord.zoom)
+    
+    if (coord.column + 1) * scale <= ul.column or coord.column * scale > lr.column:
+        return False
+    
+    if (coord.row + 1) * scale <= ul.row or coord.row * scale > lr.row:
+        return False
+    
+    return True
+
+def hilbertIndex(zoom, column, row):
+    """ Return the distance along a Hilbert curve of a tile at a zoom level.
+    """
+    side, index = 2 ** zoom, 0
+    size = side / 2
+    
+    while size > 0:
+        rx = 1 if column & size else 0
+        ry = 1 if row & size else 0
+        index += size * size * ((3 * rx) ^ ry)
+        
+        # rotate the quadrant so the curve continues in the right direction.
+        if ry == 0:
+            if rx == 1:
+                column, row = side - 1 - column, side - 1 - row
+            
+            column, row = row, column
+        
+        size /= 2
+    
+    return index
 
 if __name__ == '__main__':
 
@@ -83,6 +254,14 @@ if __name__ == '__main__':
 
     options, zooms = parser.parse_args()
     
+    try:
+        dem_budget = options.dem_budget and parse_size(options.dem_budget)
+    except ValueError:
+        parser.error('Unrecognized --dem-budget "%s", expected a size like "20G".' % options.dem_budget)
+    
+    if options.tile_list and (options.polygon or options.coverage_mask or options.order != defaults['order']):
+        parser.error('--polygon, --coverage-mask and --order only apply to tiles from --bbox, not a --tile-list.')
+    
     if options.tile_list and exists(options.tile_list):
 
         # read out zooms, columns, rows
@@ -109,12 +288,48 @@ if __name__ == '__main__':
     
             zooms[i] = int(zoom)
         
-        tiles = generateCoordinates(ul, lr, zooms, 0)
+        masks = []
+        
+        if options.polygon:
+            masks.append(load_polygon(options.polygon))
+        
+        if options.coverage_mask:
+            if options.source not in source_modules:
+                parser.error('Coverage masks need a --source of %s.' % ', '.join(sorted(source_modules)))
+            
+            masks.append(CoverageMask(options.demdir, source_modules.get(options.source, ())))
+        
+        mask = AllMasks(masks) if masks else None
+        
+        tiles = generateCoordinates(ul, lr, zooms, 0, mask, options.order)
+    
+    if options.plan:
+        plan = Plan(options.source, options.demdir, options.size, options.dem_storage)
+        
+        for (offset, count, coord) in tiles:
+            plan.add(coord)
+        
+        plan.report(stdout)
+        exit(0)
+    
+    files.storage = options.dem_storage
     
-    layer = SeedingLayer(options.demdir, options.tiledir, options.tmpdir, options.source, options.size)
+    lights = json.loads(options.png_lights) if options.png_lights else default_lights
+    layer = SeedingLayer(options.demdir, options.tiledir, options.tmpdir, options.source, options.size, options.threads, options.dedup, options.quality, options.warpdir, options.codec, options.pngdir, lights)
 
     for (offset, count, coord) in tiles:
         
         mimetype, content = getTile(layer, coord, 'TIFF', True)
 
         print coord
+        
+        if options.dem_budget and offset % budget_interval == budget_interval - 1:
+            evicted = evict(options.demdir, dem_budget)
+            
+            if evicted:
+                print >> stderr, 'Evicted %d DEM quads to stay within %s' % (len(evicted), options.dem_budget)
+
+    if options.dedup:
+        cache = layer.config.cache
+        print >> stderr, 'Saved %d tiles (%d bytes) as %d new unique payloads (%d bytes), dedup ratio %.2f' \
+            % (cache.tiles, cache.tile_bytes, cache.blobs, cache.blob_bytes, cache.ratio())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+""" Long-lived tile server for the layers in tilestache.cfg.
+
+Unlike tile.cgi, which starts a fresh Python process for every request, this
+imports GDAL, NumPy, PIL, TileStache and Hillup.tiles and parses the config
+once, then serves many requests from a few pre-forked worker processes.
+
+Run it directly for a small standalone server, e.g.:
+
+    python tile-server.py --port 8080 --workers 4
+
+It can also be used as a WSGI script under mod_wsgi or gunicorn by way of
+the module-level "application" object.
+"""
+from sys import stderr
+from os import fork, kill, waitpid, _exit
+from os.path import abspath, dirname, join
+from optparse import OptionParser
+from signal import SIGTERM
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+#
+# Preload everything a render might need, so that forked workers
+# share the imported modules and never pay for them per request.
+#
+
+from osgeo import gdal
+from PIL import Image
+import numpy
+
+from ModestMaps.Geo import Location
+import TileStache
+import Hillup.tiles
+
+config_path = join(dirname(abspath(__file__)), 'tilestache.cfg')
+
+parser = OptionParser(usage="""%prog [options]
+
+Serve tiles from tilestache.cfg with a pool of long-lived worker processes.
+
+See `%prog --help` for info.""")
+
+defaults = dict(host='localhost', port=8080, workers=4, config=config_path, warm=True)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to TileStache configuration file, default "%(config)s".' % defaults)
+
+parser.add_option('-i', '--host', dest='host',
+                  help='Host name or address to listen on, default "%(host)s".' % defaults)
+
+parser.add_option('-p', '--port', dest='port', type='int',
+                  help='Port number to listen on, default %(port)s.' % defaults)
+
+parser.add_option('-w', '--workers', dest='workers', type='int',
+                  help='Number of worker processes, default %(workers)s.' % defaults)
+
+parser.add_option('--no-warm', dest='warm', action='store_false',
+                  help='Skip rendering each Hillup layer preview tile at startup.')
+
+class QuietHandler (WSGIRequestHandler):
+    """ Request handler that doesn't log every request to stderr.
+    """
+    def log_request(self, *args, **kwargs):
+        pass
+
+def warm_up(server):
+    """ Render the preview tile of each Hillup.tiles layer once.
+
+        GDAL drivers, PIL plugins and Hillup's own module-level values are
+        initialized lazily, so doing this before forking saves every worker
+        from paying for it on its first request.
+    """
+    for (name, layer) in server.config.layers.items():
+        if not isinstance(layer.provider, Hillup.tiles.Provider):
+            continue
+
+        lat = getattr(layer, 'preview_lat', 37.80)
+        lon = getattr(layer, 'preview_lon', -122.30)
+        zoom = getattr(layer, 'preview_zoom', 10)
+
+        coord = layer.projection.locationCoordinate(Location(lat, lon))
+        coord = coord.zoomTo(zoom).container()
+
+        try:
+            layer.provider.renderTile(256, 256, layer.projection.srs, coord)
+        except Exception, e:
+            print >> stderr, 'Could not warm up layer "%s": %s' % (name, e)
+
+        # Anything still running would be stuck half-done in every worker.
+        layer.provider.drain()
+
+def serve(application, host, port, workers):
+    """ Listen on one socket and serve requests from several forked workers.
+    """
+    httpd = make_server(host, port, application, handler_class=QuietHandler)
+    children = []
+
+    for i in range(workers):
+        pid = fork()
+
+        if pid == 0:
+            # child: all workers accept() on the same listening socket.
+            try:
+                httpd.serve_forever()
+            finally:
+                _exit(0)
+
+        children.append(pid)
+
+    print >> stderr, 'Serving on http://%s:%d/ with %d workers' % (host, port, workers)
+
+    try:
+        for pid in children:
+            waitpid(pid, 0)
+
+    except KeyboardInterrupt:
+        for pid in children:
+            kill(pid, SIGTERM)
+
+application = TileStache.WSGITileServer(config_path, autoreload=False)
+
+if __name__ == '__main__':
+
+    options, args = parser.parse_args()
+
+    if options.config != config_path:
+        application = TileStache.WSGITileServer(options.config, autoreload=False)
+
+    if options.warm:
+        warm_up(application)
+
+    serve(application, options.host, options.port, options.workers)
@@ -12,6 +12,6 @@ setup(name='Hillup',
       url='https://github.com/migurski/DEM-Tools',
       requires=['ModestMaps','PIL','numpy'],
       packages=['Hillup', 'Hillup.data'],
-      scripts=['hillup-seed.py'],
+      scripts=['hillup-seed.py', 'hillup-dem.py'],
       download_url='https://github.com/downloads/migurski' % locals(),
       license='BSD')